@@ -0,0 +1,351 @@
+import argparse
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from libraries import *
+from utils_tweet_store import load_tweets
+from utils_time_features import time_features
+from utils_geo import encode_cells, cell_labels
+from utils_canton_geocoder import build_canton_geocoder
+from utils_mobility import (get_active_userIds, clean_locations, home_and_work_locations, estimate_commute,
+                            fill_cantons, radius_of_gyration, gyration_moments)
+from utils_event_detection import (parse_day_of_tweet, explode_hashtags, prefilter_candidates, candidate_groups,
+                                   detect_events_parallel, assemble_events, heuristic_events, std_of_events, fill_std,
+                                   find_canton_of_events)
+
+# folder of the materialized views, relative to this file as in the notebooks
+DATA_PATH = '../../data/'
+# default config file, next to this file
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_config.json')
+STAGES = ['mobility', 'events', 'sentiment']
+
+# values of the notebooks, overridden by the config file
+DEFAULT_CONFIG = {
+    'years': ['2010', '2011', '2012', '2013', '2014', '2015', '2016'],
+    'stages': STAGES,
+    'mobility': {'lower_threshold': 100, 'upper_threshold': 5000, 'min_tweets': 5, 'accuracy': 2},
+    'events': {'min_tweets': 5, 'eps': 100, 'dbscan_backend': 'sklearn', 'dbscan_workers': 1, 'accuracy': 3,
+               'spammer_threshold': 2, 'prefilter': True, 'prefilter_spam': False, 'sketch_width': 65536,
+               'sketch_depth': 4, 'sketch_precision': 6},
+    'sentiment': {'max_tweets': 5000, 'max_events': 2500}
+}
+
+
+def load_config(file_name=CONFIG_FILE):
+    """
+    Loads the config file, missing entries keep the values of DEFAULT_CONFIG
+
+    Parameters
+    ----------
+    file_name: JSON config file
+
+    Returns
+    -------
+    dict with the years, the stages and the thresholds of each stage
+    """
+
+    with open(file_name, 'r') as input_file:
+        user_config = json.load(input_file)
+    config = {}
+    for key, value in DEFAULT_CONFIG.items():
+        if isinstance(value, dict):
+            config[key] = dict(value, **user_config.get(key, {}))
+        else:
+            config[key] = user_config.get(key, value)
+    return config
+
+def output_file(name, year, overwrite, suffix=''):
+    """
+    Returns the path of a materialized view and whether it has to be computed
+
+    Parameters
+    ----------
+    name: prefix of the file, e.g. 'joined'
+    year: year of analysis
+    overwrite: if True, existing files are computed again
+    suffix: suffix of the file after the year
+
+    Returns
+    -------
+    tuple (file name, True if the file has to be written)
+    """
+
+    file_name = DATA_PATH + name + '_' + year + suffix + '.csv'
+    return file_name, overwrite or not os.path.isfile(file_name)
+
+def run_mobility(year, settings, overwrite=False):
+    """
+    Runs the mobility_patterns notebook: home and work locations, travel information and radius of gyration
+
+    Parameters
+    ----------
+    year: year of analysis
+    settings: 'mobility' entry of the config
+    overwrite: if True, existing files are computed again
+
+    Returns
+    -------
+    list of written files
+    """
+
+    file_processed, write_processed = output_file('processed_tweets', year, overwrite)
+    file_joined, write_joined = output_file('joined', year, overwrite)
+    file_travel, write_travel = output_file('travel_info', year, overwrite)
+    file_gyration, write_gyration = output_file('gyration', year, overwrite)
+    file_moments, write_moments = output_file('moments', year, overwrite)
+    if not (write_processed or write_joined or write_travel or write_gyration or write_moments):
+        return []
+    written = []
+    if write_processed:
+        data = load_tweets('tweets', year)
+        # keep active users
+        active_userIds = get_active_userIds(data, settings['upper_threshold'], settings['lower_threshold'])
+        data = data[data['userId'].isin(active_userIds)]
+        # use the place coordinates if the GPS coordinates are missing and remove outliers
+        data = clean_locations(data)
+        features = time_features(data['createdAt'])
+        data['atWork'] = features['atWork']
+        data['hourOfTweet'] = features['hourOfTweet']
+        data.set_index('tweetId').to_csv(path_or_buf=file_processed, sep='|')
+        written.append(file_processed)
+    elif write_joined or write_gyration or write_moments:
+        data = load_tweets('processed_tweets', year)
+
+    # home and work locations
+    accuracy = settings['accuracy']
+    if write_joined:
+        cells = encode_cells(data['latitude'].values, data['longitude'].values, accuracy)
+        joined = home_and_work_locations(data['userId'].values, cells, data['atWork'].values, accuracy,
+                                         min_tweets=settings['min_tweets'])
+        joined.to_csv(file_joined, sep='|')
+        written.append(file_joined)
+    elif write_travel:
+        joined = pd.read_csv(file_joined, sep='|', index_col=[0])
+
+    # travel information and cantons, offline
+    if write_travel:
+        geocoder = build_canton_geocoder()
+        joined = fill_cantons(estimate_commute(joined), geocoder)
+        # check if home or work is in switzerland
+        swiss_cantons = geocoder['canton_ids']
+        joined = joined[(joined['homeCanton'].isin(swiss_cantons)) | (joined['workCanton'].isin(swiss_cantons))]
+        joined.to_csv(file_travel, sep='|')
+        written.append(file_travel)
+        travel_data = joined
+    elif write_gyration:
+        travel_data = pd.read_csv(file_travel, sep='|', index_col='userId')
+
+    # radius of gyration and its moments
+    if write_gyration:
+        travel_data = travel_data.dropna()
+        gyration_info = radius_of_gyration(data['userId'].values, data['latitude'].values,
+                                           data['longitude'].values,
+                                           homes=travel_data[['homeLatitude', 'homeLongitude']])
+        gyration_info.to_csv(path_or_buf=file_gyration, sep='|')
+        written.append(file_gyration)
+    if write_moments:
+        moments = gyration_moments(data['userId'].values, data['latitude'].values, data['longitude'].values)
+        moments.to_csv(path_or_buf=file_moments, sep='|')
+        written.append(file_moments)
+    return written
+
+def run_events(year, settings, overwrite=False):
+    """
+    Runs the event_detection notebook: events detected with DBSCAN and with the heuristic
+
+    Parameters
+    ----------
+    year: year of analysis
+    settings: 'events' entry of the config
+    overwrite: if True, existing files are computed again
+
+    Returns
+    -------
+    list of written files
+    """
+
+    file_dbscan, write_dbscan = output_file('detected_events_dbscan', year, overwrite)
+    file_heuristic, write_heuristic = output_file('detected_events_heuristic', year, overwrite)
+    if not (write_dbscan or write_heuristic):
+        return []
+    min_tweets = settings['min_tweets']
+    spammer_threshold = settings['spammer_threshold']
+    data = load_tweets('tweets_with_text', year, columns=['tweetId', 'userId', 'createdAt', 'text'])
+    data.set_index('tweetId', inplace=True)
+    tweets = load_tweets('processed_tweets', year).set_index('tweetId')
+    tweets['text'] = data['text']
+    tweets = tweets.dropna(subset=['text'])
+    tweets['dayOfTweet'] = tweets['createdAt'].dt.date
+    df = explode_hashtags(tweets, ['userId', 'createdAt', 'longitude', 'latitude', 'dayOfTweet'],
+                          vocabulary_file=DATA_PATH + 'hashtags_' + year + '.csv').reset_index(drop=True)
+    # drop the (day, hashtag) groups that cannot become events, the spam groups only if asked to
+    if settings['prefilter']:
+        df = prefilter_candidates(df, min_tweets, spammer_threshold if settings['prefilter_spam'] else None,
+                                  settings['sketch_width'], settings['sketch_depth'], settings['sketch_precision'],
+                                  debug=False)
+    # keep the (day, hashtag) groups with enough tweets
+    df, _, _ = candidate_groups(df, min_tweets)
+
+    written = []
+
+    # DBSCAN
+    if write_dbscan:
+        list_of_events_dbscan = detect_events_parallel(df, settings['eps'], min_tweets,
+                                                       num_workers=settings['dbscan_workers'],
+                                                       backend=settings['dbscan_backend'], debug=False)
+        new_df = assemble_events(df, list_of_events_dbscan, spammer_threshold)
+        new_df = fill_std(new_df, std_of_events(df, ['hashtag', 'dayOfTweet']))
+        new_df = new_df.sort_values(by=['usersPerHashtag', 'std'], ascending=False).reset_index(drop=True)
+        new_df.to_csv(file_dbscan, sep='|')
+        written.append(file_dbscan)
+
+    # heuristic
+    if write_heuristic:
+        df = df.drop('numOfTweets', axis=1)
+        accuracy = settings['accuracy']
+        df['approxLocation'] = encode_cells(df['latitude'].values, df['longitude'].values, accuracy)
+        df_grouped = df.groupby(by=['dayOfTweet', 'approxLocation', 'hashtag'], observed=True).size()
+        df_grouped = df_grouped.rename('numOfTweets')
+        df_grouped = df_grouped[df_grouped >= min_tweets].to_frame()
+        joined_df = pd.merge(df, df_grouped, how='inner', left_on=['dayOfTweet', 'approxLocation', 'hashtag'],
+                             right_index=True)
+        event_detection = heuristic_events(joined_df, spammer_threshold)
+        event_detection = fill_std(event_detection,
+                                   std_of_events(df, ['dayOfTweet', 'hashtag', 'approxLocation']))
+        event_detection = event_detection.sort_values(by=['usersPerHashtag', 'std'], ascending=False)
+        event_detection['approxLocation'] = cell_labels(event_detection['approxLocation'].values, accuracy)
+        event_detection.to_csv(file_heuristic, sep='|')
+        written.append(file_heuristic)
+    return written
+
+def run_sentiment(year, settings, overwrite=False):
+    """
+    Runs the sentiment_analysis notebook: sentiment score and area of the non spam DBSCAN events.
+    Translations are only requested from the Yandex API (key in yandex.txt) if the sentiment file of
+    the year does not exist
+
+    Parameters
+    ----------
+    year: year of analysis
+    settings: 'sentiment' entry of the config
+    overwrite: if True, existing files are computed again
+
+    Returns
+    -------
+    list of written files
+    """
+
+    # imported here, so that the other stages do not need the NLP dependencies
+    from utils_sentiment_analysis import clean_tweet_text, get_sentiment, normalize_sentiment
+    from utils_sentiment_analysis import SentimentIntensityAnalyzer
+    from language_detector import detect_language
+
+    written = []
+    file_full_info, write_full_info = output_file('sentiment_analysis', year, overwrite, suffix='_full_info')
+    if not write_full_info:
+        return written
+    events = pd.read_csv(DATA_PATH + 'detected_events_dbscan_' + year + '.csv', sep='|', index_col=[0])
+    events = events[~events['spamEvent']]
+    file_name, write = output_file('sentiment_analysis', year, overwrite)
+    if write:
+        tweets_with_text = load_tweets('tweets_with_text', year, columns=['tweetId', 'createdAt', 'text'])
+        tweets_with_text['dayOfTweet'] = parse_day_of_tweet(tweets_with_text['createdAt'])
+        df = explode_hashtags(tweets_with_text.set_index('tweetId'), ['text', 'dayOfTweet'],
+                              vocabulary_file=DATA_PATH + 'hashtags_' + year + '.csv')
+        # keep only rows relevant to events
+        tweets = df[(df['dayOfTweet'].isin(events['dayOfTweet'])) & (df['hashtag'].isin(events['hashtag']))]
+        tweets['language'] = tweets['text'].apply(detect_language)
+        tweets = tweets.dropna(subset=['language'])
+        tweets['text'] = tweets['text'].apply(clean_tweet_text)
+        if tweets.shape[0] > settings['max_tweets']:
+            tweets = tweets.sample(n=settings['max_tweets'], random_state=6)
+        tweets['compound'] = np.nan
+        tweets['translated'] = 'no'
+        with open('yandex.txt', 'r') as input_file:
+            KEY = input_file.read().rstrip()
+        translate = YandexTranslate(KEY)
+        analyzer = SentimentIntensityAnalyzer()
+        tweets = tweets.apply(lambda row: get_sentiment(row, analyzer, translate, debug=False), axis=1)
+        tweets.to_csv(file_name, sep='|')
+        written.append(file_name)
+    else:
+        tweets = pd.read_csv(file_name, sep='|', index_col=[0])
+    tweets = tweets[tweets['translated'] != 'no']
+    tweets = tweets[['hashtag', 'dayOfTweet', 'compound']]
+    df = tweets.groupby(by=['hashtag', 'dayOfTweet'], observed=True).apply(normalize_sentiment)
+    df.name = 'compound'
+    df = df.reset_index()
+    events_with_sentiment = pd.merge(events, df, on=['hashtag', 'dayOfTweet'], how='inner')
+    if events_with_sentiment.shape[0] > settings['max_events']:
+        events_with_sentiment = events_with_sentiment.sample(n=settings['max_events'], random_state=6)
+    events_with_sentiment['area'] = find_canton_of_events(events_with_sentiment['approxLocation'],
+                                                          build_canton_geocoder())
+    events_with_sentiment.to_csv(file_full_info, sep='|')
+    written.append(file_full_info)
+    return written
+
+def run_year(year, stages, config, overwrite=False):
+    """
+    Runs the given stages for one year, in order. Called in a worker process
+
+    Parameters
+    ----------
+    year: year of analysis
+    stages: list of stages, in the order of STAGES
+    config: config created by load_config
+    overwrite: if True, existing files are computed again
+
+    Returns
+    -------
+    tuple (year, list of written files, elapsed seconds)
+    """
+
+    start = time.time()
+    written = []
+    if 'mobility' in stages:
+        written += run_mobility(year, config['mobility'], overwrite)
+    if 'events' in stages:
+        written += run_events(year, config['events'], overwrite)
+    if 'sentiment' in stages:
+        written += run_sentiment(year, config['sentiment'], overwrite)
+    return year, written, time.time() - start
+
+def main(args):
+    config = load_config(args.config)
+    # the paths of the notebooks are relative to this folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    years = args.years if args.years else config['years']
+    stages = [stage for stage in STAGES if stage in (args.stages if args.stages else config['stages'])]
+    # one process per year, the stages of a year depend on each other
+    workers = args.workers if args.workers else min(len(years), os.cpu_count())
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_year, year, stages, config, args.overwrite): year for year in years}
+        for future in as_completed(futures):
+            try:
+                year, written, elapsed = future.result()
+            except Exception:
+                failed.append(futures[future])
+                print('Year {0} failed:'.format(futures[future]))
+                traceback.print_exc()
+                continue
+            if not args.quiet:
+                print('Year {0} done in {1:.0f}s'.format(year, elapsed))
+                for file_name in written:
+                    print('\t' + file_name)
+    if failed:
+        raise SystemExit('Failed years: ' + ', '.join(sorted(failed)))
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Runs the notebooks' pipeline for several years in parallel")
+    argparser.add_argument("--config", type=str, help="JSON config file", default=CONFIG_FILE)
+    argparser.add_argument("--years", nargs="+", help="Years to be analyzed, overrides the config", default=None)
+    argparser.add_argument("--stages", nargs="+", choices=STAGES, help="Stages to run, overrides the config",
+                           default=None)
+    argparser.add_argument("--workers", type=int, help="Number of worker processes (default: one per year, "
+                           "up to the number of cores)", default=None)
+    argparser.add_argument("--overwrite", action="store_true",
+                           help="Compute again the files that already exist")
+    argparser.add_argument("--quiet", action="store_true")
+    parsed_args = argparser.parse_args()
+    main(parsed_args)
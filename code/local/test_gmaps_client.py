@@ -0,0 +1,152 @@
+"""
+Tests of the Google Maps client layer against a local fake server, run with `python -m pytest` from this
+directory. The googlemaps.Client is pointed at the fake server through its base_url, so no API key nor
+network access is needed.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from utils_gmaps_cache import CachedGoogleMaps
+from utils_gmaps_client import *
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    """
+    Answers distance matrix and reverse geocoding requests. The distance between two locations is their
+    Manhattan distance in units of 1e-4 degrees, the canton is 'VD' west of longitude 7 and 'ZH' east of it.
+    `failures` holds the statuses returned by the next requests before answering normally
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeHandler)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.elements = 0
+        self.failures = []
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            status = server.failures.pop(0) if server.failures else 'OK'
+        if status != 'OK':
+            body = {'status': status, 'rows': [], 'results': []}
+        elif url.path.endswith('/distancematrix/json'):
+            origins = parse_locations(query['origins'][0])
+            destinations = parse_locations(query['destinations'][0])
+            with server.lock:
+                server.elements += len(origins) * len(destinations)
+            rows = [{'elements': [element(origin, destination) for destination in destinations]}
+                    for origin in origins]
+            body = {'status': 'OK', 'rows': rows}
+        else:
+            lat, long = parse_locations(query['latlng'][0])[0]
+            canton = 'VD' if long < 7 else 'ZH'
+            components = [{'types': ['administrative_area_level_1', 'political'], 'short_name': canton}]
+            body = {'status': 'OK', 'results': [{'address_components': components}]}
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def parse_locations(value):
+    return [tuple(float(x) for x in location.split(',')) for location in value.split('|')]
+
+def fake_distance(origin, destination):
+    return int(round((abs(origin[0] - destination[0]) + abs(origin[1] - destination[1])) * 1e4))
+
+def element(origin, destination):
+    distance = fake_distance(origin, destination)
+    return {'status': 'OK', 'distance': {'value': distance}, 'duration': {'value': distance // 10}}
+
+
+@pytest.fixture
+def server():
+    server = FakeServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def gmaps(server):
+    # query limits are raised to the caller so that call_with_retries handles them
+    return googlemaps.Client(key='AIzaFakeKeyForTheLocalServer', base_url='http://127.0.0.1:{0}'.format(
+        server.server_address[1]), retry_over_query_limit=False, queries_per_second=1000)
+
+@pytest.fixture
+def joined():
+    rng = np.random.RandomState(0)
+    cells = np.round(rng.uniform([46.2, 6.1], [47.5, 9.5], size=(40, 2)), 2)
+    homes = cells[rng.randint(0, 40, 300)]
+    works = cells[rng.randint(0, 40, 300)]
+    return pd.DataFrame({'userId': np.arange(300), 'homeLatitude': homes[:, 0], 'homeLongitude': homes[:, 1],
+                         'workLatitude': works[:, 0], 'workLongitude': works[:, 1]})
+
+
+def test_pack_distance_requests_bills_only_wanted_pairs(joined):
+    pairs = set(zip(zip(joined['homeLatitude'], joined['homeLongitude']),
+                    zip(joined['workLatitude'], joined['workLongitude'])))
+    requests_ = pack_distance_requests(pairs)
+    assert sorted(pair for _, _, packed in requests_ for pair in packed) == sorted(pairs)
+    assert sum(len(origins) * len(destinations) for origins, destinations, _ in requests_) == len(pairs)
+    for origins, destinations, _ in requests_:
+        assert len(origins) == 1 or len(destinations) == 1
+        assert len(origins) <= MAX_ORIGINS and len(destinations) <= MAX_DESTINATIONS
+
+def test_fetch_travel_info(server, gmaps, joined):
+    result = fetch_travel_info(joined.copy(), gmaps, rate=100, debug=False)
+    expected = [fake_distance(home, work) for home, work in
+                zip(zip(joined['homeLatitude'], joined['homeLongitude']),
+                    zip(joined['workLatitude'], joined['workLongitude']))]
+    assert result['distance'].tolist() == expected
+    assert result['time'].tolist() == [distance // 10 for distance in expected]
+    assert server.elements == len(joined[['homeLatitude', 'homeLongitude', 'workLatitude',
+                                          'workLongitude']].drop_duplicates())
+
+def test_transient_errors_are_retried(server, gmaps, joined):
+    server.failures = ['OVER_QUERY_LIMIT', 'UNKNOWN_ERROR']
+    result = fetch_travel_info(joined.head(1).copy(), gmaps, rate=100, backoff=0.01, debug=False)
+    assert server.requests == 3
+    assert result['distance'].notnull().all()
+
+def test_other_errors_are_not_retried(server, gmaps, joined):
+    server.failures = ['REQUEST_DENIED']
+    result = fetch_travel_info(joined.head(1).copy(), gmaps, rate=100, backoff=0.01, debug=False)
+    assert server.requests == 1
+    assert result['distance'].isnull().all()
+
+def test_cached_rerun_makes_no_calls(server, gmaps, joined, tmpdir):
+    file_name = str(tmpdir.join('gmaps_cache.sqlite'))
+    cache = CachedGoogleMaps(gmaps, file_name)
+    first = fetch_cantons(fetch_travel_info(joined.copy(), cache, rate=100, debug=False), cache, rate=100,
+                          debug=False)
+    cache.close()
+    assert first['homeCanton'].tolist() == ['VD' if long < 7 else 'ZH' for long in joined['homeLongitude']]
+    calls = server.requests
+    offline = CachedGoogleMaps(None, file_name)
+    second = fetch_cantons(fetch_travel_info(joined.copy(), offline, rate=1000, debug=False), offline,
+                           rate=1000, debug=False)
+    offline.close()
+    assert server.requests == calls
+    assert offline.misses == 0
+    pd.testing.assert_frame_equal(first, second)
@@ -0,0 +1,223 @@
+from libraries import *
+from matplotlib.path import Path
+
+
+# map of the swiss cantons shipped with the repository
+CANTONS_FILE = '../../data/maps/ch-cantons.topojson.json'
+
+# labels for points outside the cantons, checked in order: (label, min lat, max lat, min long, max long)
+BORDER_ZONES = [
+    ('Liechtenstein', 47.04, 47.28, 9.47, 9.64),
+    ('Italy', -90.0, 46.85, 7.0, 180.0),
+    ('Germany', 47.53, 90.0, 7.56, 180.0),
+    ('Austria', 46.85, 47.53, 9.5, 180.0),
+    ('Germany', 47.4, 90.0, 7.56, 180.0),
+    ('France', -90.0, 90.0, -180.0, 7.56)
+]
+
+
+def decode_arcs(topology):
+    """
+    Decodes the delta-encoded, quantized arcs of a TopoJSON topology
+
+    Parameters
+    ----------
+    topology: dict loaded from a TopoJSON file
+
+    Returns
+    -------
+    list of arrays of (long, lat) points, one per arc
+    """
+
+    scale = np.array(topology['transform']['scale'])
+    translate = np.array(topology['transform']['translate'])
+    return [np.cumsum(np.array(arc, dtype=np.float64), axis=0) * scale + translate
+            for arc in topology['arcs']]
+
+def build_ring(arc_indices, arcs):
+    """
+    Builds a closed ring from a list of arc indices (a negative index ~i means arc i reversed)
+
+    Parameters
+    ----------
+    arc_indices: list of arc indices
+    arcs: decoded arcs
+
+    Returns
+    -------
+    array of (long, lat) points
+    """
+
+    points = []
+    for index in arc_indices:
+        arc = arcs[index] if index >= 0 else arcs[~index][::-1]
+        # consecutive arcs share their end points
+        points.append(arc if not points else arc[1:])
+    return np.concatenate(points)
+
+def load_canton_rings(file_name=CANTONS_FILE):
+    """
+    Loads the rings (outer boundaries and holes) of every canton
+
+    Parameters
+    ----------
+    file_name: TopoJSON file with the cantons
+
+    Returns
+    -------
+    tuple (list of canton IDs, list of lists of rings)
+    """
+
+    with open(file_name, 'r') as input_file:
+        topology = json.load(input_file)
+    arcs = decode_arcs(topology)
+    canton_ids = []
+    canton_rings = []
+    for geometry in topology['objects']['cantons']['geometries']:
+        polygons = [geometry['arcs']] if geometry['type'] == 'Polygon' else geometry['arcs']
+        canton_ids.append(geometry['id'])
+        canton_rings.append([build_ring(ring, arcs) for polygon in polygons for ring in polygon])
+    return canton_ids, canton_rings
+
+def points_in_rings(rings, points):
+    """
+    Checks which points are inside a polygon given by its rings, using the even-odd rule so that
+    holes are handled
+
+    Parameters
+    ----------
+    rings: list of arrays of (long, lat) points
+    points: array of (long, lat) points
+
+    Returns
+    -------
+    boolean array
+    """
+
+    inside = np.zeros(len(points), dtype=bool)
+    for ring in rings:
+        inside ^= Path(ring).contains_points(points)
+    return inside
+
+def build_canton_geocoder(file_name=CANTONS_FILE, grid_size=256):
+    """
+    Builds an offline canton lookup. The bounding box of Switzerland is divided into a grid; cells that no
+    canton boundary crosses get their label directly, the others keep the cantons that may contain them
+
+    Parameters
+    ----------
+    file_name: TopoJSON file with the cantons
+    grid_size: number of grid cells along each axis
+
+    Returns
+    -------
+    dict with the grid and the polygons, to be used with lookup_cantons
+    """
+
+    canton_ids, canton_rings = load_canton_rings(file_name)
+    all_points = np.concatenate([ring for rings in canton_rings for ring in rings])
+    min_long, min_lat = all_points.min(axis=0)
+    max_long, max_lat = all_points.max(axis=0)
+    step_long = (max_long - min_long) / grid_size
+    step_lat = (max_lat - min_lat) / grid_size
+    # candidates[cell, canton] is True if a boundary of the canton may cross the cell
+    candidates = np.zeros((grid_size * grid_size, len(canton_ids)), dtype=bool)
+    for canton, rings in enumerate(canton_rings):
+        for ring in rings:
+            # cells covered by the bounding box of each segment
+            start, end = ring[:-1], ring[1:]
+            long_0 = np.floor((np.minimum(start[:, 0], end[:, 0]) - min_long) / step_long).astype(int)
+            long_1 = np.floor((np.maximum(start[:, 0], end[:, 0]) - min_long) / step_long).astype(int)
+            lat_0 = np.floor((np.minimum(start[:, 1], end[:, 1]) - min_lat) / step_lat).astype(int)
+            lat_1 = np.floor((np.maximum(start[:, 1], end[:, 1]) - min_lat) / step_lat).astype(int)
+            for a, b, c, d in zip(long_0, long_1, lat_0, lat_1):
+                rows = np.arange(max(c, 0), min(d, grid_size - 1) + 1)
+                columns = np.arange(max(a, 0), min(b, grid_size - 1) + 1)
+                candidates[(rows[:, None] * grid_size + columns[None, :]).ravel(), canton] = True
+    mixed = candidates.any(axis=1)
+    # label of the cells that no boundary crosses, taken at their center (-1: outside of the cantons)
+    labels = np.full(grid_size * grid_size, -1, dtype=np.int16)
+    cell_rows, cell_columns = np.divmod(np.arange(grid_size * grid_size), grid_size)
+    centers = np.column_stack((min_long + (cell_columns + 0.5) * step_long,
+                               min_lat + (cell_rows + 0.5) * step_lat))
+    for canton, rings in enumerate(canton_rings):
+        labels[~mixed & points_in_rings(rings, centers)] = canton
+    geocoder = {
+        'canton_ids': np.array(canton_ids, dtype=object),
+        'canton_rings': canton_rings,
+        'bbox': (min_lat, max_lat, min_long, max_long),
+        'grid_size': grid_size,
+        'labels': labels,
+        'mixed': mixed,
+        'candidates': candidates
+    }
+    return geocoder
+
+def border_zones(latitude, longitude):
+    """
+    Labels points outside the cantons with the neighbouring country they fall in (approximately)
+
+    Parameters
+    ----------
+    latitude: array of latitudes
+    longitude: array of longitudes
+
+    Returns
+    -------
+    array of labels (NaN if no zone matches)
+    """
+
+    zones = np.full(len(latitude), np.nan, dtype=object)
+    unlabeled = np.ones(len(latitude), dtype=bool)
+    for label, lat_0, lat_1, long_0, long_1 in BORDER_ZONES:
+        match = (unlabeled & (lat_0 <= latitude) & (latitude <= lat_1) &
+                 (long_0 <= longitude) & (longitude <= long_1))
+        zones[match] = label
+        unlabeled &= ~match
+    return zones
+
+def lookup_cantons(geocoder, latitude, longitude, border_labels=True):
+    """
+    Finds the canton of each point without any API call, the offline counterpart of find_cantons
+
+    Parameters
+    ----------
+    geocoder: dict created by build_canton_geocoder
+    latitude: array of latitudes
+    longitude: array of longitudes
+    border_labels: if True, points outside the cantons get the label of their border zone
+
+    Returns
+    -------
+    array of canton IDs (border zone labels or NaN outside of Switzerland)
+    """
+
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    min_lat, max_lat, min_long, max_long = geocoder['bbox']
+    grid_size = geocoder['grid_size']
+    codes = np.full(len(latitude), -1, dtype=np.int16)
+    # points in the bounding box, missing coordinates are never inside
+    inside = (min_lat <= latitude) & (latitude < max_lat) & (min_long <= longitude) & (longitude < max_long)
+    points = np.flatnonzero(inside)
+    row = ((latitude[points] - min_lat) / (max_lat - min_lat) * grid_size).astype(np.int64)
+    column = ((longitude[points] - min_long) / (max_long - min_long) * grid_size).astype(np.int64)
+    cell = np.minimum(row, grid_size - 1) * grid_size + np.minimum(column, grid_size - 1)
+    # cells that no boundary crosses have a single label
+    codes[points] = geocoder['labels'][cell]
+    # exact test for the points in cells crossed by a boundary, only against the candidate cantons
+    mixed = geocoder['mixed'][cell]
+    points, cell = points[mixed], cell[mixed]
+    for canton, rings in enumerate(geocoder['canton_rings']):
+        test = geocoder['candidates'][cell, canton] & (codes[points] < 0)
+        if not test.any():
+            continue
+        coordinates = np.column_stack((longitude[points[test]], latitude[points[test]]))
+        found = points_in_rings(rings, coordinates)
+        codes[points[test][found]] = canton
+    cantons = np.full(len(latitude), np.nan, dtype=object)
+    cantons[codes >= 0] = geocoder['canton_ids'][codes[codes >= 0]]
+    if border_labels:
+        outside = (codes < 0) & ~(np.isnan(latitude) | np.isnan(longitude))
+        cantons[outside] = border_zones(latitude[outside], longitude[outside])
+    return cantons
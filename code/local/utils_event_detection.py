@@ -1,7 +1,23 @@
 from libraries import *
+import time
 from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from sklearn.cluster import DBSCAN
-
+from sklearn.neighbors import KDTree
+from utils_geo import encode_cells, decode_cells, cell_labels, haversine, to_cartesian, EARTH_RADIUS
+from utils_sketches import count_min_columns, count_min_counts, count_min_query, hll_registers, hll_estimate
+from utils_canton_geocoder import build_canton_geocoder, lookup_cantons
+from utils_time_features import day_of_tweet, seconds_of_day, time_features
+
+# words that start with '#', as found by keep_hashtags
+HASHTAG_PATTERN = r'(?<!\S)#\S*'
+# maps every character of string.punctuation to None, as the translator of the notebooks
+PUNCTUATION_TRANSLATOR = str.maketrans({key: None for key in string.punctuation})
+# columns of the saved detected_events_dbscan and detected_events_heuristic files, the spam scores come last
+DBSCAN_COLUMNS = ['hashtag', 'dayOfTweet', 'usersPerHashtag', 'spamEvent', 'std', 'approxLocation']
+HEURISTIC_COLUMNS = ['dayOfTweet', 'approxLocation', 'hashtag', 'numOfTweets', 'spamEvent', 'usersPerHashtag', 'std']
+SCORE_COLUMNS = ['spamScore', 'topUserShare', 'burstShare']
 
 def parse_day_of_tweet(date):
     """
@@ -9,13 +25,15 @@ def parse_day_of_tweet(date):
     
     Parameters
     ----------
-    data: datetime object
+    data: datetime object, or series of datetimes
     
     Returns
     ------
-    string of date
+    string of date (series of strings for a series)
     """
 
+    if isinstance(date, pd.Series):
+        return day_of_tweet(date, as_string=True)
     return str(date.date())
 
 def parse_hour_of_tweet(date):
@@ -24,13 +42,15 @@ def parse_hour_of_tweet(date):
     
     Parameters
     ----------
-    data: datetime object
+    data: datetime object, or series of datetimes
     
     Returns
     ------
-    tweet hour
+    tweet hour (series of hours for a series)
     """
 
+    if isinstance(date, pd.Series):
+        return pd.to_datetime(date).dt.time
     return date.time()
 
 def keep_hashtags(tweet):
@@ -76,23 +96,164 @@ def hashtag_preprocess(hashtag, translator):
     # return hashtag without punctuation
     return '#' + hashtag.translate(translator)
 
-def fill_num_of_tweets(row, df_grouped):
+def load_hashtag_vocabulary(file_name):
     """
-    Find the number of tweets given the day of tweet and the hashtag
-    
+    Loads the hashtags interned so far, in the order of their codes
+
     Parameters
     ----------
-    row: dataframe row
-    df_grouped: Series that contains the hashtag and day of tweets as index and the number of tweets as value
-    
+    file_name: csv file of the vocabulary
+
     Returns
     -------
-    new row containing the number of tweets for a particular day with the particular hashtag
+    list of hashtags (empty if the file does not exist)
     """
 
-    # use dayOfTweet and hashtag as index and find the number of tweets using the df_grouped Series
-    row['numOfTweets'] = df_grouped.ix[(row['dayOfTweet'], row['hashtag'])]
-    return row
+    if file_name is None or not os.path.isfile(file_name):
+        return []
+    return pd.read_csv(file_name, sep='|', keep_default_na=False)['hashtag'].tolist()
+
+def intern_hashtags(hashtags, vocabulary_file=None):
+    """
+    Interns hashtags into a categorical, so that each distinct hashtag is stored once and groupbys work on
+    small integer codes. With a vocabulary file, new hashtags are appended to the ones of previous runs,
+    so that the event detection and the sentiment analysis of a year share the same codes
+
+    Parameters
+    ----------
+    hashtags: array of normalized hashtags
+    vocabulary_file: csv file of the vocabulary, None for a vocabulary of the given hashtags only
+
+    Returns
+    -------
+    pandas Categorical of the hashtags
+    """
+
+    vocabulary = load_hashtag_vocabulary(vocabulary_file)
+    known = set(vocabulary)
+    new = sorted(hashtag for hashtag in pd.unique(hashtags) if hashtag not in known)
+    if new and vocabulary_file is not None:
+        pd.DataFrame({'hashtag': vocabulary + new}).to_csv(vocabulary_file, sep='|', index=False)
+    return pd.Categorical(hashtags, categories=vocabulary + new)
+
+def explode_hashtags(tweets, columns, text_column='text', vocabulary_file=None):
+    """
+    Creates one row per (tweet, hashtag) with normalized hashtags, the vectorized counterpart of
+    keep_hashtags, the pairs loop of the notebooks and hashtag_preprocess. As in keep_hashtags, a hashtag
+    repeated in a tweet is kept once
+
+    Parameters
+    ----------
+    tweets: dataframe of tweets
+    columns: columns of the tweets kept for each row
+    text_column: column with the text of the tweets
+    vocabulary_file: csv file of the hashtag vocabulary shared by the notebooks, see intern_hashtags
+
+    Returns
+    -------
+    a dataframe with the index of the tweets, the given columns and a categorical hashtag column
+    """
+
+    # words starting with '#' of each tweet, one row per word, indexed by the position of the tweet
+    words = pd.Series(tweets[text_column].astype(str).str.findall(HASHTAG_PATTERN).values).explode().dropna()
+    pairs = pd.DataFrame({'position': words.index.values, 'word': words.values}).drop_duplicates()
+    # lowercase and remove punctuation
+    hashtags = '#' + pairs['word'].str.lower().str.translate(PUNCTUATION_TRANSLATOR)
+    df = tweets[columns].iloc[pairs['position'].values]
+    df['hashtag'] = intern_hashtags(hashtags.values, vocabulary_file)
+    return df
+
+def group_codes(df):
+    """
+    Maps the (dayOfTweet, hashtag) pair of each row to a single integer code
+
+    Parameters
+    ----------
+    df: dataframe with the dayOfTweet and hashtag columns
+
+    Returns
+    -------
+    int64 array of codes, rows of the same day and hashtag share the same code
+    """
+
+    # days since the first day
+    days = pd.to_datetime(df['dayOfTweet']).values.astype('datetime64[D]').astype(np.int64)
+    if len(days):
+        days -= days.min()
+    # codes of the interned hashtags, or of the distinct hashtags of a plain column
+    if isinstance(df['hashtag'].dtype, pd.CategoricalDtype):
+        hashtags = df['hashtag'].cat.codes.values.astype(np.int64)
+        num_hashtags = len(df['hashtag'].cat.categories)
+    else:
+        hashtags, uniques = pd.factorize(df['hashtag'])
+        num_hashtags = len(uniques)
+    return days * max(num_hashtags, 1) + hashtags
+
+def candidate_groups(df, min_tweets):
+    """
+    Finds the (day, hashtag) groups with at least min_tweets tweets with a single sort of the group codes,
+    the vectorized counterpart of the groupby size and fill_num_of_tweets
+
+    Parameters
+    ----------
+    df: dataframe with one row per (tweet, hashtag)
+    min_tweets: minimum number of tweets of a group
+
+    Returns
+    -------
+    tuple (dataframe with the rows of the kept groups sorted by group and the numOfTweets column, index
+    of the first row of each group, number of rows of each group); the rows of group i are
+    candidates.iloc[starts[i]:starts[i] + sizes[i]]
+    """
+
+    codes = group_codes(df)
+    order = np.argsort(codes, kind='mergesort')
+    codes = codes[order]
+    # size of each group of the sorted codes
+    starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1]))
+    sizes = np.diff(np.append(starts, len(codes)))
+    keep = sizes >= min_tweets
+    candidates = df.iloc[order[np.repeat(keep, sizes)]].reset_index(drop=True)
+    sizes = sizes[keep]
+    candidates['numOfTweets'] = np.repeat(sizes, sizes)
+    starts = np.cumsum(sizes) - sizes
+    return candidates, starts, sizes
+
+def prefilter_candidates(df, min_tweets, spammer_threshold=None, width=2 ** 16, depth=4, precision=6,
+                         debug=True):
+    """
+    Drops the (day, hashtag) groups that cannot become events before any exact grouping. The tweets of each
+    group are counted with a count-min sketch, which never underestimates, so no group with at least
+    min_tweets tweets is dropped; a group is kept by mistake with probability about e^-depth when the
+    tweets of other groups that share its columns add up to more than about e / width of all the tweets.
+    The distinct users of each group are estimated with HyperLogLog sketches in the cells of the same table
+    (relative error about 1.04 / sqrt(2^precision)); groups whose estimate is below spammer_threshold are
+    dropped too. The memory is depth x width counters plus depth x width x 2^precision one-byte registers
+
+    Parameters
+    ----------
+    df: dataframe with one row per (tweet, hashtag) and the dayOfTweet, hashtag and userId columns
+    min_tweets: minimum number of tweets of a group
+    spammer_threshold: minimum number of distinct users of a group, None to keep the spam groups
+    width: number of columns of the sketches
+    depth: number of rows of the sketches
+    precision: number of bits of the register index of the HyperLogLog sketches
+    debug: if True, print debug message
+
+    Returns
+    -------
+    the rows of df whose group may reach the thresholds
+    """
+
+    columns = count_min_columns(group_codes(df), width, depth)
+    keep = count_min_query(count_min_counts(columns, width), columns) >= min_tweets
+    if spammer_threshold is not None:
+        estimates = hll_estimate(hll_registers(columns[:, keep], df['userId'].values[keep], width, precision))
+        users = np.take_along_axis(estimates, columns[:, keep], axis=1).min(axis=0)
+        keep[keep] = users >= spammer_threshold
+    if debug:
+        print('Prefilter kept {0} of {1} rows'.format(keep.sum(), len(keep)))
+    return df[keep]
 
 def train_dbscan(coordinates, eps, min_samples):
     """
@@ -151,13 +312,14 @@ def visualize_dbscan(dbscan, coordinates):
     plt.title('Estimated number of clusters: %d' % n_clusters_)
     plt.show()
 
-def detect_event_dbscan(df_grouped, accuracy, min_tweets):
+def detect_event_dbscan(df, accuracy, min_tweets):
     """
     Detects events using geolocated information, if any exist
     
     Parameters
     ----------
-    df_grouped: a grouped dataframe based on day of tweet and hashtag 
+    df: dataframe with one row per (tweet, hashtag), whose (day, hashtag) groups with at least min_tweets
+    tweets are found by candidate_groups; a dataframe grouped by day of tweet and hashtag is also accepted
     (geolocated information should be contained in the dataframe)
     min_tweets = minimum number of tweets to form cluster
     accuracy: how close points should be to form a cluster
@@ -167,10 +329,15 @@ def detect_event_dbscan(df_grouped, accuracy, min_tweets):
     list of tuples of events (date, hashtag)
     """
 
+    if isinstance(df, pd.DataFrame):
+        # contiguous slices of the candidate groups
+        candidates, starts, sizes = candidate_groups(df, min_tweets)
+        slices = (candidates.iloc[start:start + size] for start, size in zip(starts, sizes))
+        df = (((dataframe['dayOfTweet'].iat[0], dataframe['hashtag'].iat[0]), dataframe) for dataframe in slices)
     # initialize list of events
     list_of_events = []
     # iterate though all groups
-    for index, dataframe in df_grouped:
+    for index, dataframe in df:
         # keep coordinates
         coordinates = dataframe[['longitude', 'latitude']]
         # train dbscan
@@ -202,132 +369,412 @@ def detect_event_dbscan(df_grouped, accuracy, min_tweets):
     # return list of events
     return list_of_events
 
-def is_spam_event(row, threshold):
+def cluster_groups(coordinates, groups, eps, min_tweets):
     """
-    Finds if an event is spam or not
-    
+    Runs DBSCAN with the haversine metric on a batch of (day, hashtag) groups
+
     Parameters
     ----------
-    row: row of dataframe 
-    threshold: spammer threshold
-    
+    coordinates: array of (lat, long) coordinates of all groups, in degrees
+    groups: list of (group index, first row, number of rows) tuples
+    eps: maximum distance between two neighbours, in radians
+    min_tweets: minimum number of tweets to form cluster
+
     Returns
     -------
-    True of False
+    list of (group index, (avg lat, avg long)) tuples, one per cluster, formatted as in detect_event_dbscan
     """
 
-    if(row['usersPerHashtag'] < threshold):
-        row['spamEvent'] = True
-    else:
-        row['spamEvent'] = False
-    return row
+    events = []
+    for group, start, size in groups:
+        points = coordinates[start:start + size]
+        dbscan = DBSCAN(eps=eps, min_samples=min_tweets, metric='haversine', algorithm='ball_tree')
+        labels = dbscan.fit(np.radians(points)).labels_
+        for label in np.unique(labels[labels >= 0]):
+            avg_lat, avg_long = points[labels == label].mean(axis=0)
+            events.append((group, ("{0:.3f}".format(avg_lat), "{0:.3f}".format(avg_long))))
+    return events
 
-def std_of_events(df, new_df=None):
+def cluster_shared_groups(name, shape, groups, eps, min_tweets):
     """
-    Finds the standard deviation of events
-    
+    Runs cluster_groups in a worker process on coordinates stored in shared memory
+
     Parameters
     ----------
-    df: dataframe with all tweets that may be events
-    new_df: dataframe with hashtags and day of tweets that are detected as events
+    name: name of the shared memory block
+    shape: shape of the coordinates array
+    groups, eps, min_tweets: as in cluster_groups
 
     Returns
     -------
-    dict with events as keys and std as values
-    """
-
-    # create a dict to store timestamps for each event
-    d = defaultdict(list)
-    if new_df is not None:
-        # keep timestamp and hashtag for each event
-        event_indices = new_df.index.values.tolist()
-        # iterate though all rows
-        for line in df.iterrows():
-            # keep timestame
-            timestamp = line[1][1]
-            # keep hashtag
-            hashtag = line[1][5] 
-            # keep dayOfTweet
-            dayOfTweet = line[1][4]
-            # if the row refers to a detected event, keep timestamp
-            if(hashtag, dayOfTweet) in event_indices:   
-                d[hashtag, dayOfTweet].append(timestamp)
-    else:
-        for line in df.iterrows():
-            hashtag = line[1][4] 
-            dayOfTweet = line[1][5]
-            approxLocation = line[1][6]
-            hour = line[1][1]
-            d[hashtag, dayOfTweet, approxLocation].append(hour)
-    # iterate though dictionary and convert timestamps to seconds
-    for key, values in d.items():
-        # count seconds from midnight
-        midnight = values[0].replace(hour=0, minute=0, second=0)
-        # convert to seconds
-        d[key] = [(value - midnight).total_seconds() for value in values]
-    # build dict for the standard deviation
-    std_dict = dict()
-    for key, value in d.items():
-        if len(value) > 1:
-            # calculate std
-            std_dict[key] = np.std(value)
-    return std_dict
-
-def fill_std(row, std_dict):
-    """
-    Fills the std value for each event
-    
+    the events of cluster_groups
+    """
+
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        coordinates = np.ndarray(shape, dtype=np.float64, buffer=block.buf)
+        return cluster_groups(coordinates, groups, eps, min_tweets)
+    finally:
+        block.close()
+
+def union_find(num_nodes, a, b):
+    """
+    Connected components of a graph given by its edges, with a vectorized union-find: the root of each edge
+    end is hooked to the smaller root and the paths are compressed, until no edge joins two roots
+
     Parameters
     ----------
-    row: row of dataframe
-    std_dict: dictionary with events and their respective std
-    
+    num_nodes: number of nodes
+    a: array of first ends of the edges
+    b: array of second ends of the edges
+
+    Returns
+    -------
+    array with the root of the component of each node
+    """
+
+    parent = np.arange(num_nodes)
+    while True:
+        root_a, root_b = parent[a], parent[b]
+        joined = root_a != root_b
+        if not joined.any():
+            return parent
+        # hook the larger root to the smaller one
+        np.minimum.at(parent, np.maximum(root_a, root_b)[joined], np.minimum(root_a, root_b)[joined])
+        # compress the paths, every node then points to its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+def grid_clusters(latitude, longitude, starts, sizes, eps, min_tweets):
+    """
+    Approximate DBSCAN of all groups at once in linear time. Points are bucketed into cells of eps x eps
+    meters; a cell is dense if its 3 x 3 neighbourhood of cells has at least min_tweets points, neighbouring
+    dense cells are joined with union-find, and the cells next to a dense cell join its cluster
+
+    Parameters
+    ----------
+    latitude: array of latitudes, sorted by group
+    longitude: array of longitudes, sorted by group
+    starts: index of the first point of each group
+    sizes: number of points of each group
+    eps: size of the cells, in meters
+    min_tweets: minimum number of tweets to form cluster
+
     Returns
     -------
-    new row that contains std information
-    """
-
-    # case if approxLocation is in keys
-    if 'approxLocation' in row.keys():
-        # define dict key
-        key = (row['dayOfTweet'], row['hashtag'], row['approxLocation'])
-        try:
-            # get value from dict
-            std = std_dict[key]
-        except:
-            # return NaN if key does not exist
-            std = np.nan
+    array with the cluster of each point (-1 for noise), clusters never span two groups
+    """
+
+    if len(latitude) == 0:
+        return np.zeros(0, dtype=np.int64)
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    # project each group on a plane, in meters
+    reference = np.radians(np.add.reduceat(latitude, starts) / sizes)
+    y = np.radians(latitude) * EARTH_RADIUS * 1000.0
+    x = np.radians(longitude) * EARTH_RADIUS * 1000.0 * np.cos(reference[groups])
+    # cell coordinates relative to the first cell of the group, with a margin of one cell
+    column = np.floor(x / eps).astype(np.int64)
+    row = np.floor(y / eps).astype(np.int64)
+    column -= np.repeat(np.minimum.reduceat(column, starts), sizes) - 1
+    row -= np.repeat(np.minimum.reduceat(row, starts), sizes) - 1
+    width, height = column.max() + 2, row.max() + 2
+    cells, point_cell, counts = np.unique((groups * height + row) * width + column, return_inverse=True,
+                                          return_counts=True)
+    # neighbouring cells, the margin makes sure that they never wrap into another row or group
+    neighbours = []
+    for offset in [d_row * width + d_column for d_row in (-1, 0, 1) for d_column in (-1, 0, 1)]:
+        index = np.minimum(np.searchsorted(cells, cells + offset), len(cells) - 1)
+        found = cells[index] == cells + offset
+        neighbours.append((offset, index, found))
+    density = sum(np.where(found, counts[index], 0) for _, index, found in neighbours)
+    dense = density >= min_tweets
+    # join the neighbouring dense cells
+    cell_ids = np.arange(len(cells))
+    edges = [(cell_ids[found & dense & dense[index]], index[found & dense & dense[index]])
+             for offset, index, found in neighbours if offset != 0]
+    a = np.concatenate([edge[0] for edge in edges])
+    b = np.concatenate([edge[1] for edge in edges])
+    labels = np.where(dense, union_find(len(cells), a, b), -1)
+    # the other cells join the cluster of a dense neighbour, if any
+    for offset, index, found in neighbours:
+        border = (labels < 0) & found & dense[index]
+        labels[border] = labels[index[border]]
+    return labels[point_cell]
+
+def detect_events_parallel(df, eps, min_tweets, num_workers=None, batch_tweets=50000, backend='sklearn',
+                           debug=True):
+    """
+    Detects events with DBSCAN in parallel worker processes, the parallel counterpart of detect_event_dbscan.
+    Distances are great-circle distances, so eps is given in meters. The coordinates are copied once into
+    shared memory and the (day, hashtag) groups are sent to the workers in batches of about batch_tweets
+    tweets; groups with less than min_tweets tweets cannot form a cluster and are skipped. With the 'grid'
+    backend, all groups are clustered at once in this process by grid_clusters, an approximate DBSCAN
+
+    Parameters
+    ----------
+    df: dataframe with one row per (tweet, hashtag)
+    eps: maximum distance between two neighbours, in meters
+    min_tweets: minimum number of tweets to form cluster
+    num_workers: number of worker processes, None for all cores, 1 to run in this process
+    batch_tweets: number of tweets per batch of groups
+    backend: 'sklearn' for DBSCAN, 'grid' for the grid-hashing approximation
+    debug: if True, print the detected events
+
+    Returns
+    -------
+    list of tuples of events (date, hashtag, (avg lat, avg long)), as detect_event_dbscan
+    """
+
+    if backend not in ('sklearn', 'grid'):
+        raise ValueError("backend should be 'sklearn' or 'grid'")
+    candidates, starts, sizes = candidate_groups(df, min_tweets)
+    coordinates = np.ascontiguousarray(candidates[['latitude', 'longitude']].values, dtype=np.float64)
+    if backend == 'grid':
+        labels = grid_clusters(coordinates[:, 0], coordinates[:, 1], starts, sizes, eps, min_tweets)
+        clustered = np.flatnonzero(labels >= 0)
+        _, first, point_cluster, counts = np.unique(labels[clustered], return_index=True, return_inverse=True,
+                                                    return_counts=True)
+        # average location of each cluster, clusters are sorted by group
+        avg_lat = np.bincount(point_cluster, weights=coordinates[clustered, 0]) / counts
+        avg_long = np.bincount(point_cluster, weights=coordinates[clustered, 1]) / counts
+        group_of_cluster = np.searchsorted(starts, clustered[first], side='right') - 1
+        results = [[(group, ("{0:.3f}".format(lat), "{0:.3f}".format(long)))
+                    for group, lat, long in zip(group_of_cluster, avg_lat, avg_long)]]
     else:
-        # define dict key
-        key = (row['hashtag'], row['dayOfTweet'])
-        try:
-            # get value from dict
-            std = std_dict[key]
-        except:
-            # return NaN if key does not exist 
-            std = np.nan
-    # convert std to minutes
-    row['std'] = std / 60
-    return row
+        eps = eps / (EARTH_RADIUS * 1000.0)
+        # batches of consecutive groups with about batch_tweets tweets
+        batch_ids = np.cumsum(sizes) // batch_tweets
+        batches = [[(group, starts[group], sizes[group]) for group in np.flatnonzero(batch_ids == batch_id)]
+                   for batch_id in np.unique(batch_ids)]
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        if num_workers == 1 or len(batches) <= 1:
+            results = [cluster_groups(coordinates, batch, eps, min_tweets) for batch in batches]
+        else:
+            block = shared_memory.SharedMemory(create=True, size=max(coordinates.nbytes, 1))
+            try:
+                np.ndarray(coordinates.shape, dtype=np.float64, buffer=block.buf)[:] = coordinates
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    futures = [executor.submit(cluster_shared_groups, block.name, coordinates.shape, batch, eps,
+                                               min_tweets) for batch in batches]
+                    results = [future.result() for future in futures]
+            finally:
+                block.close()
+                block.unlink()
+    # initialize list of events
+    list_of_events = []
+    days = candidates['dayOfTweet'].values
+    hashtags = candidates['hashtag'].values
+    for group, avg_loc in (event for result in results for event in result):
+        list_of_events.append((days[starts[group]], hashtags[starts[group]], avg_loc))
+        if debug:
+            print('Date: ', days[starts[group]], '\t', 'Location: ', avg_loc, '\t', 'Hashtags: ',
+                  hashtags[starts[group]])
+    return list_of_events
 
-def set_event_location(row, list_of_events_dbscan):
+def compare_backends(df, eps, min_tweets, num_workers=None):
     """
-    Set the location of events using the list_of_events_dbscan list
-    
+    Benchmarks the grid backend of detect_events_parallel against sklearn DBSCAN
+
     Parameters
     ----------
-    row: row of dataframe
-    list_of_events_dbscan: list of events with (dayOfTweet, hashtag, location)
-    
+    df: dataframe with one row per (tweet, hashtag)
+    eps: maximum distance between two neighbours, in meters
+    min_tweets: minimum number of tweets to form cluster
+    num_workers: number of worker processes of the sklearn backend
+
+    Returns
+    -------
+    a dataframe indexed by backend with the running time in seconds, the number of events, the agreement
+    with sklearn (Jaccard index of the detected (day, hashtag) pairs) and the median distance in meters
+    between an event and the closest sklearn event of the same day and hashtag
+    """
+
+    frames = {}
+    stats = []
+    for backend in ['sklearn', 'grid']:
+        start = time.time()
+        events = detect_events_parallel(df, eps, min_tweets, num_workers=num_workers, backend=backend,
+                                        debug=False)
+        seconds = time.time() - start
+        frames[backend] = pd.DataFrame([(day, hashtag, float(lat), float(long))
+                                        for day, hashtag, (lat, long) in events],
+                                       columns=['dayOfTweet', 'hashtag', 'latitude', 'longitude'])
+        stats.append((backend, seconds, len(events)))
+    stats = pd.DataFrame(stats, columns=['backend', 'seconds', 'events']).set_index('backend')
+    reference = set(zip(frames['sklearn']['dayOfTweet'], frames['sklearn']['hashtag']))
+    for backend, frame in frames.items():
+        found = set(zip(frame['dayOfTweet'], frame['hashtag']))
+        stats.loc[backend, 'agreement'] = len(found & reference) / float(max(len(found | reference), 1))
+        pairs = pd.merge(frame.reset_index(), frames['sklearn'], on=['dayOfTweet', 'hashtag'])
+        pairs['distance'] = haversine(pairs['latitude_x'], pairs['longitude_x'], pairs['latitude_y'],
+                                      pairs['longitude_y']) * 1000
+        stats.loc[backend, 'medianDistance'] = pairs.groupby('index')['distance'].min().median()
+    return stats
+
+def flag_spam(events, spammer_threshold, max_score=None):
+    """
+    Flags the spam events from their scores, so that the thresholds can be changed on saved events
+
+    Parameters
+    ----------
+    events: dataframe with the usersPerHashtag and spamScore columns
+    spammer_threshold: events with less users are spam
+    max_score: events with a higher spamScore are spam, None to use the users only
+
+    Returns
+    -------
+    the events with the spamEvent column
+    """
+
+    spam = events['usersPerHashtag'] < spammer_threshold
+    if max_score is not None:
+        spam |= events['spamScore'] > max_score
+    events['spamEvent'] = spam
+    return events
+
+def spam_scores(tweets, keys, spammer_threshold, burst_seconds=60, max_score=None):
+    """
+    Scores how likely each event is to be created by spammers, in one pass over the tweets sorted by event,
+    user and time. The signals of an event are its number of distinct users, the share of its tweets posted by
+    its most active user and the share of its tweets posted less than burst_seconds after the previous tweet
+    of the same user; the spamScore is the average of 1 / users, the top user share and the burst share, from
+    0 (many users, no bursts) to 1 (a single user posting in bursts)
+
+    Parameters
+    ----------
+    tweets: dataframe with the tweets of the events and the userId and createdAt columns
+    keys: columns that identify an event
+    spammer_threshold: events with less users are spam
+    burst_seconds: maximum time between two tweets of a burst, in seconds
+    max_score: events with a higher spamScore are spam, None to use the users only
+
+    Returns
+    -------
+    dataframe indexed by the keys with the usersPerHashtag, spamEvent, spamScore, topUserShare and burstShare
+    columns
+    """
+
+    grouped = tweets.groupby(by=keys, observed=True)
+    index = grouped.size().index
+    events = grouped.ngroup().values
+    users = pd.factorize(tweets['userId'])[0]
+    seconds = tweets['createdAt'].values.astype('datetime64[s]').astype(np.int64)
+    order = np.lexsort((seconds, users, events))
+    events, users, seconds = events[order], users[order], seconds[order]
+    # first tweet of each (event, user)
+    first = np.ones(len(events), dtype=bool)
+    first[1:] = (events[1:] != events[:-1]) | (users[1:] != users[:-1])
+    starts = np.flatnonzero(first)
+    num_tweets = np.bincount(events, minlength=len(index))
+    num_users = np.bincount(events[starts], minlength=len(index))
+    top_user = np.zeros(len(index), dtype=np.int64)
+    np.maximum.at(top_user, events[starts], np.diff(np.append(starts, len(events))))
+    burst = np.zeros(len(events), dtype=bool)
+    burst[1:] = ~first[1:] & (np.diff(seconds) < burst_seconds)
+    num_bursts = np.bincount(events[burst], minlength=len(index))
+    scores = pd.DataFrame({'usersPerHashtag': num_users, 'spamEvent': False, 'spamScore': np.nan,
+                           'topUserShare': top_user / np.maximum(num_tweets, 1),
+                           'burstShare': num_bursts / np.maximum(num_tweets, 1)}, index=index)
+    scores['spamScore'] = (1.0 / np.maximum(num_users, 1) + scores['topUserShare'] + scores['burstShare']) / 3
+    return flag_spam(scores, spammer_threshold, max_score)
+
+def assemble_events(df, list_of_events, spammer_threshold):
+    """
+    Builds the dataframe of the events detected with DBSCAN: one row per (hashtag, dayOfTweet), with the
+    number of users that posted with the hashtag on that day, the spam flag and scores (see spam_scores) and the
+    location of the first event of the list. The tweets of the events are found with a join instead of a scan
+    per event
+
+    Parameters
+    ----------
+    df: dataframe with one row per (tweet, hashtag) and the userId and createdAt columns
+    list_of_events: list of events (dayOfTweet, hashtag, location), created by detect_events_parallel
+    spammer_threshold: events with less users are spam
+
+    Returns
+    -------
+    dataframe with the DBSCAN_COLUMNS, std being empty until fill_std, and the SCORE_COLUMNS
+    """
+
+    locations = pd.DataFrame(list_of_events, columns=['dayOfTweet', 'hashtag', 'approxLocation'])
+    locations = locations.drop_duplicates(subset=['dayOfTweet', 'hashtag']).set_index(['hashtag', 'dayOfTweet'])
+    # tweets of the detected events
+    tweets = df[['hashtag', 'dayOfTweet', 'userId', 'createdAt']]
+    tweets = tweets.join(locations[[]], on=['hashtag', 'dayOfTweet'], how='inner')
+    events = spam_scores(tweets, ['hashtag', 'dayOfTweet'], spammer_threshold)
+    events = events.join(locations).reset_index()
+    events['std'] = np.nan
+    return events[DBSCAN_COLUMNS + SCORE_COLUMNS]
+
+def heuristic_events(joined_df, spammer_threshold):
+    """
+    Builds the dataframe of the events detected with the heuristic: one row per (dayOfTweet, approxLocation,
+    hashtag), with its number of tweets and users and the spam flag and scores (see spam_scores). Each row is
+    indexed by the first tweet of its event, as in the saved detected_events_heuristic files
+
+    Parameters
+    ----------
+    joined_df: dataframe with the tweets of the events and the userId and createdAt columns
+    spammer_threshold: events with less users are spam
+
+    Returns
+    -------
+    dataframe with the HEURISTIC_COLUMNS, std being empty until fill_std, and the SCORE_COLUMNS
+    """
+
+    keys = ['dayOfTweet', 'approxLocation', 'hashtag']
+    events = spam_scores(joined_df, keys, spammer_threshold)
+    rows = pd.Series(joined_df.index, index=joined_df.index).groupby([joined_df[key] for key in keys], observed=True)
+    events['numOfTweets'] = rows.size()
+    events['firstRow'] = rows.first()
+    events = events.reset_index().set_index('firstRow').rename_axis(None)
+    events['std'] = np.nan
+    return events[HEURISTIC_COLUMNS + SCORE_COLUMNS]
+
+def std_of_events(df, keys):
+    """
+    Finds the standard deviation of the time of day of the tweets of each event with a single groupby
+
+    Parameters
+    ----------
+    df: dataframe with all tweets that may be events and the createdAt column
+    keys: columns that identify an event, e.g. ['hashtag', 'dayOfTweet'] for DBSCAN or
+    ['dayOfTweet', 'hashtag', 'approxLocation'] for the heuristic
+
     Returns
     -------
-    the location of the events using the hashtag and the day of tweet
+    dataframe indexed by the keys with the std in minutes (NaN for a single tweet) and the number of tweets
+    """
+
+    seconds = pd.Series(seconds_of_day(df['createdAt']), index=df.index, dtype=np.float64)
+    # missing timestamps are ignored
+    seconds[seconds < 0] = np.nan
+    grouped = seconds.groupby([df[key] for key in keys], observed=True)
+    stds = pd.DataFrame({'std': grouped.std(ddof=0) / 60, 'numOfTweets': grouped.count()})
+    stds.loc[stds['numOfTweets'] < 2, 'std'] = np.nan
+    return stds
+
+def fill_std(events, stds):
     """
+    Fills the std value of each event by joining on the event keys
 
-    for item in list_of_events_dbscan:
-        if row['hashtag'] == item[1] and row['dayOfTweet'] == item[0]:
-            return item[2]
-    return np.nan
+    Parameters
+    ----------
+    events: dataframe of events with the key columns of stds
+    stds: dataframe created by std_of_events
+
+    Returns
+    -------
+    the events with the std column, in place of the previous one if any, NaN for events without std
+    """
+
+    columns = list(events.columns) + ([] if 'std' in events.columns else ['std'])
+    events = events.drop(columns='std', errors='ignore')
+    return events.join(stds['std'], on=list(stds.index.names))[columns]
 
 def reduce_location_accuracy(row, accuracy):
     """
@@ -350,32 +797,6 @@ def reduce_location_accuracy(row, accuracy):
     row['approxLocation'] = (lat, long)
     return row
 
-def spam_events(row, users_per_hashtag, threshold):
-    """
-    Finds if an event is created due to spam and the users per hashtag on a particular day and location
-    
-    Parameters
-    ----------
-    row: row of dataframe
-    users_per_hashtag: series with key = (hashtag, dayOfTweet, approxLocation) and value = number of users
-    threshold: spammer threshold
-    
-    Returns
-    -------
-    new row
-    """
-
-    # build key to look-up in the series
-    key = (row['hashtag'], row['dayOfTweet'], row['approxLocation'])
-    # check if value is above threshold
-    if users_per_hashtag.ix[key] >= threshold:
-        row['spamEvent'] = False
-    else:
-        row['spamEvent'] = True
-    # find users per key
-    row['usersPerHashtag'] = users_per_hashtag[key]
-    return row
-
 def find_canton_of_event(coordinates, gmaps, swiss_cantons, debug=True):
     """
     Finds the canton of residence and work
@@ -409,6 +830,26 @@ def find_canton_of_event(coordinates, gmaps, swiss_cantons, debug=True):
     except:
     	return np.nan
 
+def find_canton_of_events(coordinates, geocoder):
+    """
+    Finds the canton of all events at once, without the googlemaps API
+
+    Parameters
+    ----------
+    coordinates: series of event coordinates given as strings, e.g. "('47.383', '8.536')"
+    geocoder: dict created by build_canton_geocoder
+
+    Returns
+    ------
+    array of canton IDs (the neighbouring country outside of Switzerland)
+    """
+
+    # convert from string to tuple
+    coordinates = [literal_eval(item) if isinstance(item, str) else (np.nan, np.nan) for item in coordinates]
+    latitude = np.array([float(lat) for lat, _ in coordinates], dtype=np.float64)
+    longitude = np.array([float(long) for _, long in coordinates], dtype=np.float64)
+    return lookup_cantons(geocoder, latitude, longitude)
+
 def create_event_map(year, coord, hashtag, spams, usersPerHashtag):
     """
     Visualize the non-spam events in Switzerland
@@ -442,38 +883,125 @@ def create_event_map(year, coord, hashtag, spams, usersPerHashtag):
     event_map.save(map_name)
     return event_map
 
-def analyse_performance(list_of_events_dbscan, list_of_events_heuristic):
+def events_frame(events):
     """
-    Analyses the performance of the two approaches given their results
-    
+    Converts a list of events to a dataframe of distinct events
+
     Parameters
-    list_of_events_dbscan: list of events detected using DBSCAN
-    list_of_events_heuristic: list of events detected using the heuristic
-    """
-    
-    # remove the location information from the lists
-    list_of_events_dbscan = [(str(item[0]), item[1]) for item in list_of_events_dbscan]
-    list_of_events_heuristic = [(str(item[0]), item[1]) for item in list_of_events_heuristic] 
-    # how many events are detected by DBSCAN
-    method_1 = len(set(list_of_events_dbscan))
-    # how many events are detected by the heuristic
-    method_2 = len(set(list_of_events_heuristic))
-    print('Number of events detected with DBSCAN = ', method_1)
-    print('Number of events detected with heuristic = ', method_2)
-    print('---------------------------------------------')
-    # find common events
-    common_events_1 = [str(event) for event in list_of_events_dbscan if event in list_of_events_heuristic]
-    common_events_2 = [str(event) for event in list_of_events_heuristic if event in list_of_events_dbscan]
-    common_events = set(common_events_1 + common_events_2)
-    print('The two methods found {0} events in common'.format(len(common_events)))
-    print('Common events:')
-    print('\n'.join(common_events))
-    # find events detected by only one method
-    only_dbscan = [str(event) for event in list_of_events_dbscan if event not in list_of_events_heuristic]
-    only_heuristic = [str(event) for event in list_of_events_heuristic if event not in list_of_events_dbscan]
-    print('---------------------------------------------')
-    print('Found only by DBSCAN:')
-    print('\n'.join(only_dbscan))
-    print('---------------------------------------------')
-    print('Found only by heuristic:')
-    print('\n'.join(only_heuristic))
\ No newline at end of file
+    ----------
+    events: list of (dayOfTweet, hashtag) or (dayOfTweet, hashtag, (lat, long)) tuples, or a dataframe with
+    the dayOfTweet, hashtag and optionally approxLocation columns; locations may be tuples of strings
+    or their string representation, as read from the saved files
+
+    Returns
+    -------
+    dataframe with the day (days since the epoch), hashtag, latitude and longitude (NaN if unknown) columns
+    """
+
+    if not isinstance(events, pd.DataFrame):
+        events = pd.DataFrame([tuple(event) + (np.nan,) * (3 - len(event)) for event in events],
+                              columns=['dayOfTweet', 'hashtag', 'approxLocation'])
+    if 'approxLocation' not in events:
+        events = events.assign(approxLocation=np.nan)
+    locations = [literal_eval(item) if isinstance(item, str) else item for item in events['approxLocation']]
+    locations = np.array([item if isinstance(item, tuple) else (np.nan, np.nan) for item in locations],
+                         dtype=np.float64).reshape(-1, 2)
+    frame = pd.DataFrame({'day': pd.to_datetime(pd.Series(events['dayOfTweet'].values).astype(str))
+                                   .values.astype('datetime64[D]').astype(np.int64),
+                          'hashtag': events['hashtag'].astype(str).values,
+                          'latitude': locations[:, 0], 'longitude': locations[:, 1]})
+    return frame.drop_duplicates().reset_index(drop=True)
+
+def match_events(events_1, events_2, distance=None, days=0):
+    """
+    Finds the pairs of matching events of two methods. Without distance, events match when they have the same
+    day and hashtag (hash join). With a distance, events match when they have the same hashtag, are at most
+    days apart and their locations are at most distance meters apart; the candidates are found with a
+    KD-tree over the 3D points of the locations, the scaled day and the hashtag code
+
+    Parameters
+    ----------
+    events_1: dataframe created by events_frame
+    events_2: dataframe created by events_frame
+    distance: tolerance in meters, None to match on day and hashtag only
+    days: tolerance in days
+
+    Returns
+    -------
+    dataframe with the index of the events of each method (index1, index2), their distance in meters and
+    the difference of their days
+    """
+
+    if distance is None:
+        keys = ['day', 'hashtag']
+        pairs = pd.merge(events_1[keys].reset_index().drop_duplicates(subset=keys),
+                         events_2[keys].reset_index().drop_duplicates(subset=keys),
+                         on=keys, suffixes=('1', '2'))[['index1', 'index2']]
+        return pairs.assign(distance=np.nan, dayDifference=0)
+    if events_1[['latitude', 'longitude']].isna().any().any() or \
+            events_2[['latitude', 'longitude']].isna().any().any():
+        raise ValueError('matching with a distance needs the locations of all events')
+    codes, _ = pd.factorize(pd.concat([events_1['hashtag'], events_2['hashtag']]))
+
+    def points(events, hashtags):
+        # in the Chebyshev metric, every tolerance becomes a distance of 1
+        x, y, z = to_cartesian(events['latitude'].values, events['longitude'].values)
+        return np.column_stack([x * 1000.0 / distance, y * 1000.0 / distance, z * 1000.0 / distance,
+                                events['day'].values / (days + 0.5), hashtags * 2.0])
+
+    tree = KDTree(points(events_2, codes[len(events_1):]), metric='chebyshev')
+    neighbours = tree.query_radius(points(events_1, codes[:len(events_1)]), r=1.0)
+    index_1 = np.repeat(np.arange(len(events_1)), [len(item) for item in neighbours])
+    index_2 = np.concatenate(list(neighbours) + [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+    meters = 1000.0 * haversine(events_1['latitude'].values[index_1], events_1['longitude'].values[index_1],
+                                events_2['latitude'].values[index_2], events_2['longitude'].values[index_2])
+    keep = meters <= distance
+    index_1, index_2 = index_1[keep], index_2[keep]
+    return pd.DataFrame({'index1': index_1, 'index2': index_2, 'distance': meters[keep],
+                         'dayDifference': events_2['day'].values[index_2] - events_1['day'].values[index_1]})
+
+def analyse_performance(list_of_events_dbscan, list_of_events_heuristic, distance=None, days=0):
+    """
+    Analyses the performance of the two approaches given their results. Without distance, events are compared
+    on their day and hashtag; with a distance, events also need to be close in space (and in days)
+
+    Parameters
+    ----------
+    list_of_events_dbscan: list or dataframe of events detected using DBSCAN
+    list_of_events_heuristic: list or dataframe of events detected using the heuristic
+    distance: tolerance in meters, None to ignore the locations
+    days: tolerance in days, used with a distance
+
+    Returns
+    -------
+    dict of dataframes: 'summary' with the number of events, matched events, precision (share of the events
+    found by the other method too) and overlap of each method, 'common' with the matching pairs,
+    'only_dbscan' and 'only_heuristic' with the events found by one method only
+    """
+
+    events = {}
+    for name, list_of_events in (('dbscan', list_of_events_dbscan), ('heuristic', list_of_events_heuristic)):
+        events[name] = events_frame(list_of_events)
+        if distance is None:
+            events[name] = events[name].drop_duplicates(subset=['day', 'hashtag']).reset_index(drop=True)
+        events[name]['dayOfTweet'] = events[name]['day'].values.astype('datetime64[D]')
+    pairs = match_events(events['dbscan'], events['heuristic'], distance, days)
+    matched = {'dbscan': np.unique(pairs['index1']), 'heuristic': np.unique(pairs['index2'])}
+    total = len(events['dbscan']) + len(events['heuristic'])
+    overlap = (len(matched['dbscan']) + len(matched['heuristic'])) / float(total) if total else np.nan
+    summary = pd.DataFrame({'events': [len(events[name]) for name in events],
+                            'matched': [len(matched[name]) for name in events]},
+                           index=pd.Index(['DBSCAN', 'heuristic'], name='method'))
+    summary['precision'] = summary['matched'] / summary['events'].replace(0, np.nan)
+    summary['overlap'] = overlap
+    columns = ['dayOfTweet', 'hashtag', 'latitude', 'longitude']
+    common = pd.concat([events['dbscan'][columns].iloc[pairs['index1'].values].reset_index(drop=True),
+                        events['heuristic'][columns].iloc[pairs['index2'].values].reset_index(drop=True)
+                        .add_suffix('Heuristic'),
+                        pairs[['distance', 'dayDifference']].reset_index(drop=True)], axis=1)
+    tables = {'summary': summary, 'common': common}
+    for name in events:
+        only = np.ones(len(events[name]), dtype=bool)
+        only[matched[name]] = False
+        tables['only_' + name] = events[name].loc[only, columns].reset_index(drop=True)
+    return tables
@@ -0,0 +1,127 @@
+from libraries import *
+from utils_geo import encode_cells, cell_labels
+from utils_sketches import kmv_add, kmv_merge, kmv_count
+
+
+class StreamingEventDetector(object):
+    """
+    Online counterpart of the heuristic event detection. Tweets are given in timestamp order; the tweets of
+    each (hashtag, cell) are counted over a sliding time window, split in panes, together with a sketch of
+    their distinct users. An event is emitted as soon as a (hashtag, cell) has at least min_tweets tweets
+    from at least spammer_threshold users within the window, and at most once per window. Panes older than
+    the window are dropped, so the memory depends on the window and not on the length of the stream.
+
+    Parameters
+    ----------
+    accuracy: number of decimals of the cells, as the heuristic
+    min_tweets: minimum number of tweets of an event
+    spammer_threshold: minimum number of distinct users of an event
+    window: length of the window in seconds
+    pane: length of a pane in seconds, the window slides by one pane
+    k: size of the distinct-user sketches, counts below k are exact
+    """
+
+    def __init__(self, accuracy=3, min_tweets=5, spammer_threshold=2, window=86400, pane=3600, k=16):
+        self.accuracy = accuracy
+        self.min_tweets = min_tweets
+        self.spammer_threshold = spammer_threshold
+        self.num_panes = max(int(window // pane), 1)
+        self.pane = pane
+        self.k = max(k, spammer_threshold)
+        # pane ID -> {(hashtag, cell): [number of tweets, sketch of the users]}
+        self.panes = {}
+        self.latest = None
+        # (hashtag, cell) -> pane ID of the last emitted event
+        self.emitted = {}
+
+    def expire(self):
+        """
+        Drops the panes and the emitted events that left the window
+        """
+
+        oldest = self.latest - self.num_panes
+        for pane_id in [pane_id for pane_id in self.panes if pane_id <= oldest]:
+            del self.panes[pane_id]
+        for key in [key for key, pane_id in self.emitted.items() if pane_id <= oldest]:
+            del self.emitted[key]
+
+    def update(self, timestamp, user_id, cell, hashtag):
+        """
+        Adds one (tweet, hashtag) to the window
+
+        Parameters
+        ----------
+        timestamp: time of the tweet in seconds since the epoch
+        user_id: user ID
+        cell: grid cell of the tweet, created by encode_cells
+        hashtag: normalized hashtag
+
+        Returns
+        -------
+        the event as a tuple (hashtag, cell, number of tweets, number of users) if it is emitted by this
+        tweet, otherwise None
+        """
+
+        pane_id = int(timestamp // self.pane)
+        if self.latest is None or pane_id > self.latest:
+            self.latest = pane_id
+            self.expire()
+        elif pane_id <= self.latest - self.num_panes:
+            # too late for the window
+            return None
+        key = (hashtag, cell)
+        counter = self.panes.setdefault(pane_id, {}).setdefault(key, [0, []])
+        counter[0] += 1
+        kmv_add(counter[1], user_id, self.k)
+        if key in self.emitted:
+            return None
+        counters = [pane[key] for pane in self.panes.values() if key in pane]
+        num_tweets = sum(counter[0] for counter in counters)
+        if num_tweets < self.min_tweets:
+            return None
+        num_users = kmv_count(kmv_merge([counter[1] for counter in counters], self.k), self.k)
+        if num_users < self.spammer_threshold:
+            return None
+        self.emitted[key] = pane_id
+        return hashtag, cell, num_tweets, int(round(num_users))
+
+    def size(self):
+        """
+        Returns the number of (hashtag, cell) counters kept in the window
+        """
+
+        return sum(len(pane) for pane in self.panes.values())
+
+
+def detect_events_streaming(df, accuracy=3, min_tweets=5, spammer_threshold=2, window=86400, pane=3600, k=16):
+    """
+    Replays time-ordered (tweet, hashtag) rows through a StreamingEventDetector
+
+    Parameters
+    ----------
+    df: dataframe with one row per (tweet, hashtag) and the userId, createdAt, latitude, longitude and
+    hashtag columns
+    accuracy, min_tweets, spammer_threshold, window, pane, k: parameters of StreamingEventDetector
+
+    Returns
+    -------
+    a dataframe with one row per emitted event: the time of the tweet that emitted it, its day, its
+    approximate location as a (lat, long) tuple, the hashtag and the numbers of tweets and users
+    """
+
+    detector = StreamingEventDetector(accuracy, min_tweets, spammer_threshold, window, pane, k)
+    df = df.sort_values(by='createdAt', kind='mergesort')
+    cells = encode_cells(df['latitude'].values, df['longitude'].values, accuracy)
+    seconds = df['createdAt'].values.astype('datetime64[s]').astype(np.int64)
+    events = []
+    for created_at, timestamp, user_id, cell, hashtag in zip(df['createdAt'], seconds, df['userId'].values,
+                                                              cells, df['hashtag'].values):
+        if cell < 0:
+            continue
+        event = detector.update(timestamp, user_id, cell, hashtag)
+        if event is not None:
+            events.append((created_at, created_at.date(), event[1], event[0], event[2], event[3]))
+    events = pd.DataFrame(events, columns=['createdAt', 'dayOfTweet', 'approxLocation', 'hashtag', 'numOfTweets',
+                                           'usersPerHashtag'])
+    events['approxLocation'] = cell_labels(events['approxLocation'].values.astype(np.int64), accuracy)
+    return events
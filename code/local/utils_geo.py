@@ -0,0 +1,170 @@
+from libraries import *
+
+
+# latitudes are shifted by 2^30 and longitudes by 2^31 so that both fit in unsigned 32-bit halves
+LATITUDE_SHIFT = 2 ** 30
+LONGITUDE_SHIFT = 2 ** 31
+# beyond this many decimals the shifted coordinates no longer fit in 32 bits
+MAX_ACCURACY = 7
+# mean radius of the earth in km
+EARTH_RADIUS = 6371.0
+
+
+def check_accuracy(accuracy):
+    """
+    Makes sure that cells of the given accuracy can be packed in an int64
+
+    Parameters
+    ----------
+    accuracy: how many decimals of the coordinates are kept
+    """
+
+    if not 0 <= accuracy <= MAX_ACCURACY:
+        raise ValueError('accuracy should be between 0 and {0} decimals'.format(MAX_ACCURACY))
+
+def round_coordinates(values, accuracy):
+    """
+    Rounds coordinates to integer multiples of 10^-accuracy as "{0:.Nf}".format does in
+    reduce_location_accuracy. Scaling by 10^accuracy is not exact, so the values that end up close to half a
+    cell are rounded by formatting them, float32 values with their shortest representation. The rounding is
+    exact for float64 coordinates; float32 coordinates with more than 7 significant digits have lost the
+    digits that decide, and about 10^(accuracy - 6) of them may still fall in a neighbouring cell
+
+    Parameters
+    ----------
+    values: array of coordinates without NaN
+    accuracy: how many decimals should be kept
+
+    Returns
+    -------
+    int64 array of the rounded coordinates times 10^accuracy
+    """
+
+    values = np.asarray(values)
+    if values.dtype != np.float32:
+        values = values.astype(np.float64)
+    scaled = values.astype(np.float64) * 10 ** accuracy
+    rounded = np.rint(scaled)
+    # bound of the error of the scaled value, float32 coordinates being less precise than their decimals
+    tolerance = 4 * np.finfo(values.dtype).eps * np.abs(scaled)
+    ambiguous = np.flatnonzero(np.abs(np.abs(scaled - rounded) - 0.5) <= tolerance)
+    number_format = '{0:.' + str(accuracy) + 'f}'
+    rounded[ambiguous] = [int(number_format.format(float(str(x))).replace('.', '')) for x in values[ambiguous]]
+    return rounded.astype(np.int64)
+
+def encode_cells(latitude, longitude, accuracy):
+    """
+    Maps coordinates to integer grid cells, the vectorized counterpart of reduce_location_accuracy.
+    Two coordinates fall in the same cell if they are equal once rounded to the given number of decimals,
+    with the rounding of reduce_location_accuracy (see round_coordinates)
+
+    Parameters
+    ----------
+    latitude: array of latitudes
+    longitude: array of longitudes
+    accuracy: how many decimals should be kept
+
+    Returns
+    -------
+    int64 array of cell IDs (-1 where a coordinate is missing)
+    """
+
+    check_accuracy(accuracy)
+    latitude = np.array(latitude, dtype=np.float32 if np.asarray(latitude).dtype == np.float32 else np.float64)
+    longitude = np.array(longitude, dtype=np.float32 if np.asarray(longitude).dtype == np.float32 else np.float64)
+    missing = np.isnan(latitude) | np.isnan(longitude)
+    latitude[missing] = 0
+    longitude[missing] = 0
+    # round to the grid and shift to non-negative integers
+    lat = round_coordinates(latitude, accuracy) + LATITUDE_SHIFT
+    long = round_coordinates(longitude, accuracy) + LONGITUDE_SHIFT
+    # pack latitude in the high and longitude in the low 32 bits
+    cells = (lat << 32) | long
+    cells[missing] = -1
+    return cells
+
+def decode_cells(cells, accuracy):
+    """
+    Maps integer grid cells back to the rounded coordinates of their centers
+
+    Parameters
+    ----------
+    cells: array of cell IDs created by encode_cells
+    accuracy: accuracy used to create the cells
+
+    Returns
+    -------
+    tuple of arrays (latitude, longitude), NaN for missing cells
+    """
+
+    check_accuracy(accuracy)
+    cells = np.asarray(cells, dtype=np.int64)
+    scale = float(10 ** accuracy)
+    lat = ((cells >> 32) - LATITUDE_SHIFT) / scale
+    long = ((cells & 0xFFFFFFFF) - LONGITUDE_SHIFT) / scale
+    missing = cells < 0
+    lat[missing] = np.nan
+    long[missing] = np.nan
+    return lat, long
+
+def cell_labels(cells, accuracy):
+    """
+    Formats integer grid cells as the (lat, long) string tuples written by reduce_location_accuracy,
+    so that saved files keep their format
+
+    Parameters
+    ----------
+    cells: array of cell IDs created by encode_cells
+    accuracy: accuracy used to create the cells
+
+    Returns
+    -------
+    list of (lat, long) string tuples, NaN for missing cells
+    """
+
+    lat, long = decode_cells(cells, accuracy)
+    number_format = '{0:.' + str(accuracy) + 'f}'
+    return [(number_format.format(x), number_format.format(y)) if not np.isnan(x) else np.nan
+            for x, y in zip(lat, long)]
+
+def haversine(lat_1, long_1, lat_2, long_2):
+    """
+    Great-circle distance between two arrays of coordinates
+
+    Parameters
+    ----------
+    lat_1: array of latitudes of the first points
+    long_1: array of longitudes of the first points
+    lat_2: array of latitudes of the second points
+    long_2: array of longitudes of the second points
+
+    Returns
+    -------
+    array of distances in km
+    """
+
+    lat_1, long_1, lat_2, long_2 = [np.radians(np.asarray(x, dtype=np.float64))
+                                    for x in (lat_1, long_1, lat_2, long_2)]
+    a = (np.sin((lat_2 - lat_1) / 2) ** 2 +
+         np.cos(lat_1) * np.cos(lat_2) * np.sin((long_2 - long_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+def to_cartesian(latitude, longitude):
+    """
+    Maps coordinates to 3D points on the sphere of the earth
+
+    Parameters
+    ----------
+    latitude: array of latitudes
+    longitude: array of longitudes
+
+    Returns
+    -------
+    tuple of arrays (x, y, z) in km
+    """
+
+    latitude = np.radians(np.asarray(latitude, dtype=np.float64))
+    longitude = np.radians(np.asarray(longitude, dtype=np.float64))
+    return (EARTH_RADIUS * np.cos(latitude) * np.cos(longitude),
+            EARTH_RADIUS * np.cos(latitude) * np.sin(longitude),
+            EARTH_RADIUS * np.sin(latitude))
@@ -0,0 +1,148 @@
+from libraries import *
+import sqlite3
+import threading
+import time
+
+
+# default location of the cache, relative to the notebooks
+CACHE_FILE = '../../data/gmaps_cache.sqlite'
+
+
+class CacheMissError(KeyError):
+    """
+    Raised by a read-only cache when a request is not cached
+    """
+
+
+class CachedGoogleMaps(object):
+    """
+    Persistent cache in front of a googlemaps.Client. It exposes distance_matrix and reverse_geocode with
+    the same signatures, so it can be passed wherever the notebooks pass gmaps (get_travel_info,
+    find_cantons, find_canton_of_event). Requests are keyed by their coordinates rounded to `accuracy`
+    decimals, so users that share the same rounded cells share the same cached response.
+
+    Parameters
+    ----------
+    client: googlemaps.Client object, None for an offline cache
+    file_name: SQLite file of the cache
+    accuracy: number of decimals of the coordinates in the keys
+    ttl: time to live of an entry in seconds, None to keep entries forever
+    max_entries: maximum number of entries, the least recently used are evicted first; None for no limit
+    read_only: if True, never call the API nor modify the cache, a miss raises CacheMissError
+
+    The connection is shared by the threads of fetch_travel_info and fetch_cantons, every access to it is
+    serialized by a lock while the API calls themselves run concurrently
+    """
+
+    def __init__(self, client=None, file_name=CACHE_FILE, accuracy=4, ttl=None, max_entries=None,
+                 read_only=False):
+        self.client = client
+        self.accuracy = accuracy
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.read_only = read_only or client is None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (kind TEXT, key TEXT, response TEXT, '
+                                'created REAL, accessed REAL, PRIMARY KEY (kind, key))')
+        self.connection.commit()
+
+    def location_key(self, location):
+        """
+        Formats a (lat, long) location, or a list of them, with the accuracy of the cache
+        """
+
+        if np.ndim(location) == 2:
+            return ';'.join(self.location_key(l) for l in location)
+        lat, long = location
+        number_format = '{0:.' + str(self.accuracy) + 'f}'
+        return number_format.format(float(lat)) + ',' + number_format.format(float(long))
+
+    def request(self, kind, key, call):
+        """
+        Returns the cached response of a request, calling the API on a miss
+
+        Parameters
+        ----------
+        kind: type of request ('distance_matrix' or 'reverse_geocode')
+        key: key of the request
+        call: function that performs the request
+
+        Returns
+        -------
+        the response of the request
+        """
+
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute('SELECT response, created FROM cache WHERE kind = ? AND key = ?',
+                                          (kind, key)).fetchone()
+            if row is not None and (self.ttl is None or now - row[1] <= self.ttl):
+                self.hits += 1
+                if not self.read_only:
+                    self.connection.execute('UPDATE cache SET accessed = ? WHERE kind = ? AND key = ?',
+                                            (now, kind, key))
+                    self.connection.commit()
+                return json.loads(row[0])
+            self.misses += 1
+        if self.read_only:
+            raise CacheMissError((kind, key))
+        # errors of the API are not cached and reach the caller as before
+        response = call()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                                    (kind, key, json.dumps(response), now, now))
+            self.evict(now)
+            self.connection.commit()
+        return response
+
+    def evict(self, now):
+        """
+        Removes expired entries and, above max_entries, the least recently used ones
+        """
+
+        if self.ttl is not None:
+            self.connection.execute('DELETE FROM cache WHERE created < ?', (now - self.ttl,))
+        if self.max_entries is not None:
+            self.connection.execute('DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache '
+                                    'ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        """
+        Cached googlemaps distance_matrix for (lat, long) origins and destinations, single or lists
+        """
+
+        key = self.location_key(origins) + '|' + self.location_key(destinations)
+        if kwargs:
+            key += '|' + json.dumps(kwargs, sort_keys=True)
+        return self.request('distance_matrix', key,
+                            lambda: self.client.distance_matrix(origins, destinations, **kwargs))
+
+    def reverse_geocode(self, latlng, **kwargs):
+        """
+        Cached googlemaps reverse_geocode for a (lat, long) location
+        """
+
+        key = self.location_key(latlng)
+        if kwargs:
+            key += '|' + json.dumps(kwargs, sort_keys=True)
+        return self.request('reverse_geocode', key, lambda: self.client.reverse_geocode(latlng, **kwargs))
+
+    def stats(self):
+        """
+        Returns the hits, misses and number of entries of the cache
+        """
+
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+    def close(self):
+        """
+        Closes the SQLite connection
+        """
+
+        with self.lock:
+            self.connection.close()
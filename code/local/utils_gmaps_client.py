@@ -0,0 +1,268 @@
+from libraries import *
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from googlemaps.exceptions import ApiError, HTTPError, Timeout, TransportError
+from utils_gmaps_cache import CacheMissError
+
+# limits of a single distance matrix request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+# statuses of the API worth retrying, the others (e.g. REQUEST_DENIED, INVALID_REQUEST) fail the same way
+TRANSIENT_STATUSES = ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket: at most `rate` requests per second on average, with bursts of at most
+    `capacity` requests
+
+    Parameters
+    ----------
+    rate: number of tokens added per second
+    capacity: maximum number of tokens in the bucket
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient(error):
+    """
+    Tells whether a failed request may succeed when retried: timeouts, network errors, server errors and
+    query limits
+
+    Parameters
+    ----------
+    error: exception raised by the googlemaps client
+
+    Returns
+    -------
+    True if the request should be retried
+    """
+
+    if isinstance(error, HTTPError):
+        return error.status_code >= 500
+    if isinstance(error, (Timeout, TransportError)):
+        return True
+    return isinstance(error, ApiError) and error.status in TRANSIENT_STATUSES
+
+def call_with_retries(call, bucket, max_retries=5, backoff=1.0, debug=True):
+    """
+    Calls the API under the rate limiter, retrying transient errors with exponential backoff. Other errors
+    of the API and misses of a read-only cache fail the request at once, any other exception is raised
+
+    Parameters
+    ----------
+    call: function that performs the request
+    bucket: TokenBucket object
+    max_retries: number of retries before giving up
+    backoff: waiting time before the first retry in seconds, doubled at each retry
+    debug: if True, print debug message
+
+    Returns
+    -------
+    the response of the request, None if the request failed
+    """
+
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        try:
+            return call()
+        except (ApiError, TransportError, Timeout, CacheMissError) as error:
+            if debug:
+                print('Request failed ({0}), attempt {1} of {2}'.format(error, attempt + 1, max_retries + 1))
+            if not is_transient(error):
+                return None
+            if attempt < max_retries:
+                time.sleep(backoff * 2 ** attempt)
+    return None
+
+def pack_distance_requests(pairs, max_origins=MAX_ORIGINS, max_destinations=MAX_DESTINATIONS,
+                           max_elements=MAX_ELEMENTS):
+    """
+    Packs (origin, destination) pairs into distance matrix requests. Each request has either a single origin
+    and the destinations of its pairs, or a single destination and the origins of its pairs, so that every
+    billed element of a response is a wanted pair. Pairs are first grouped by shared origin, the pairs left
+    alone with their origin are then grouped by shared destination
+
+    Parameters
+    ----------
+    pairs: list of distinct ((lat, long), (lat, long)) pairs
+    max_origins: maximum number of origins per request
+    max_destinations: maximum number of destinations per request
+    max_elements: maximum number of elements (origins x destinations) per request
+
+    Returns
+    -------
+    list of (origins, destinations, pairs) tuples, one per request
+    """
+
+    by_origin = defaultdict(list)
+    for origin, destination in sorted(pairs):
+        by_origin[origin].append(destination)
+    requests_ = []
+    by_destination = defaultdict(list)
+    for origin, destinations in by_origin.items():
+        if len(destinations) == 1:
+            by_destination[destinations[0]].append(origin)
+            continue
+        size = min(max_destinations, max_elements)
+        for i in range(0, len(destinations), size):
+            chunk = destinations[i:i + size]
+            requests_.append(([origin], chunk, [(origin, destination) for destination in chunk]))
+    for destination, origins in by_destination.items():
+        size = min(max_origins, max_elements)
+        for i in range(0, len(origins), size):
+            chunk = origins[i:i + size]
+            requests_.append((chunk, [destination], [(origin, destination) for origin in chunk]))
+    return requests_
+
+def parse_distance_matrix(response, origins, destinations, pairs):
+    """
+    Extracts distance and time of each pair from a distance matrix response
+
+    Parameters
+    ----------
+    response: response of the API (None if the request failed)
+    origins: origins of the request
+    destinations: destinations of the request
+    pairs: pairs covered by the request
+
+    Returns
+    -------
+    dict pair -> (distance in meters, time in seconds), NaN for invalid elements
+    """
+
+    results = {}
+    for origin, destination in pairs:
+        try:
+            element = response['rows'][origins.index(origin)]['elements'][destinations.index(destination)]
+            results[(origin, destination)] = (element['distance']['value'], int(element['duration']['value']))
+        except (TypeError, KeyError, IndexError):
+            results[(origin, destination)] = (np.nan, np.nan)
+    return results
+
+def fetch_travel_info(joined, gmaps, rate=10, num_threads=8, max_retries=5, backoff=1.0, debug=True):
+    """
+    Gets time and distance to work of all users with batched, concurrent and rate-limited distance matrix
+    requests. Users that share the same home and work coordinates share one element of a request
+
+    Parameters
+    ----------
+    joined: dataframe with home and work coordinates
+    gmaps: googlemaps object
+    rate: maximum number of requests per second
+    num_threads: number of concurrent requests
+    max_retries: number of retries of a failed request
+    backoff: waiting time before the first retry in seconds
+    debug: if True, print debug message
+
+    Returns
+    -------
+    the dataframe with the distance (meters) and time (seconds) columns filled, as get_travel_info does
+    """
+
+    homes = list(zip(joined['homeLatitude'].values.tolist(), joined['homeLongitude'].values.tolist()))
+    works = list(zip(joined['workLatitude'].values.tolist(), joined['workLongitude'].values.tolist()))
+    pairs = list(zip(homes, works))
+    requests_ = pack_distance_requests(set(pairs))
+    bucket = TokenBucket(rate)
+
+    def run(request):
+        origins, destinations, packed = request
+        response = call_with_retries(lambda: gmaps.distance_matrix(origins, destinations), bucket,
+                                     max_retries, backoff, debug)
+        return parse_distance_matrix(response, origins, destinations, packed)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for result in executor.map(run, requests_):
+            results.update(result)
+    if debug:
+        print('{0} distance matrix requests for {1} users'.format(len(requests_), len(pairs)))
+    # write the results back into the dataframe
+    joined['distance'] = [results[pair][0] for pair in pairs]
+    joined['time'] = [results[pair][1] for pair in pairs]
+    return joined
+
+def canton_from_geocode(result):
+    """
+    Extracts the canton (administrative_area_level_1) from a reverse geocoding result, as find_cantons does
+
+    Parameters
+    ----------
+    result: response of reverse_geocode (None if the request failed)
+
+    Returns
+    -------
+    short name of the canton, NaN if not found
+    """
+
+    try:
+        for d in result[0]['address_components']:
+            if d['types'][0] == 'administrative_area_level_1':
+                return d['short_name']
+    except (TypeError, KeyError, IndexError):
+        pass
+    return np.nan
+
+def fetch_cantons(joined, gmaps, rate=10, num_threads=8, max_retries=5, backoff=1.0, debug=True):
+    """
+    Finds the canton of residence and work of all users with concurrent and rate-limited reverse geocoding
+    requests, one per distinct location
+
+    Parameters
+    ----------
+    joined: dataframe with home and work coordinates
+    gmaps: googlemaps object
+    rate: maximum number of requests per second
+    num_threads: number of concurrent requests
+    max_retries: number of retries of a failed request
+    backoff: waiting time before the first retry in seconds
+    debug: if True, print debug message
+
+    Returns
+    -------
+    the dataframe with the homeCanton and workCanton columns filled
+    """
+
+    homes = list(zip(joined['homeLatitude'].values.tolist(), joined['homeLongitude'].values.tolist()))
+    works = list(zip(joined['workLatitude'].values.tolist(), joined['workLongitude'].values.tolist()))
+    locations = sorted(set(homes + works))
+    bucket = TokenBucket(rate)
+
+    def run(location):
+        result = call_with_retries(lambda: gmaps.reverse_geocode(location), bucket, max_retries, backoff, debug)
+        return canton_from_geocode(result)
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        cantons = dict(zip(locations, executor.map(run, locations)))
+    if debug:
+        print('{0} reverse geocoding requests for {1} users'.format(len(locations), len(homes)))
+    # write the results back into the dataframe
+    joined['homeCanton'] = [cantons[location] for location in homes]
+    joined['workCanton'] = [cantons[location] for location in works]
+    return joined
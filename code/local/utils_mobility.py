@@ -1,4 +1,18 @@
 from libraries import *
+from utils_tweet_store import read_cached_csv, is_memmap_store, iter_user_chunks
+from utils_geo import encode_cells, decode_cells, haversine, to_cartesian, EARTH_RADIUS
+from utils_canton_geocoder import build_canton_geocoder, lookup_cantons
+from utils_sketches import space_saving_update
+from utils_time_features import time_features, working_hours, WORK_DAYS, WORK_START, WORK_END
+
+# commute model fitted with fit_commute_model on the travel_info files of 2010-2016
+COMMUTE_MODEL = {'detour': 1.432, 'detour_offset': 0.949, 'time_per_km': 0.547,
+                 'time_per_sqrt_km': 2.094, 'time_offset': 4.014}
+# sufficient statistics of the radius of gyration, see gyration_moments
+MOMENT_COLUMNS = ['tweets', 'sumX', 'sumY', 'sumZ']
+# bounding box of the tweets kept by the notebook, outside of it tweets are outliers
+LATITUDE_RANGE = (45, 48)
+LONGITUDE_RANGE = (5, 11)
 
 
 def fill_gps_coordinates(row):
@@ -93,13 +107,16 @@ def count_tweets_per_user(data):
     
     Parameters
     ----------
-    data: dataframe of the dataset
+    data: dataframe of the dataset, or store opened with open_memmap_store
     
     Returns
     ------
     number of tweets per user
     """
 
+    if is_memmap_store(data):
+        # the offset table already holds the number of tweets of each user
+        return pd.Series(np.sort(np.diff(data['offsets'])), name='numOfTweets')
     # group by userId and count 
     tweets_per_user = data[['userId', 'createdAt']].groupby(by='userId', as_index=False).count()
     tweets_per_user = tweets_per_user['createdAt'].copy()
@@ -139,7 +156,7 @@ def get_active_userIds(data, upper_threshold=5000, lower_threshold=50):
     
     Parameters
     ----------
-    data: dataframe of the Twitter dataset
+    data: dataframe of the Twitter dataset, or store opened with open_memmap_store
     lower_threshold: minimum number of tweets to detect an active user
     upper_threshold: maximum number of tweets to detect an active user
     
@@ -148,6 +165,12 @@ def get_active_userIds(data, upper_threshold=5000, lower_threshold=50):
     a list of user IDs for the active users
     """
 
+    if is_memmap_store(data):
+        # the offset table already holds the number of tweets of each user
+        tweets_per_user = np.diff(data['offsets'])
+        active = (tweets_per_user >= lower_threshold) & (tweets_per_user <= upper_threshold)
+        return data['users'][active].tolist()
+
     # group by user ID and count tweets
     tweets_per_user = data.groupby(by='userId', as_index=False).count()
     # keep only those above threshold
@@ -203,6 +226,241 @@ def most_freq_locations(df):
     result.columns = ['frequentLocation', 'numTweets']
     return result
 
+def at_work_from_epoch(epoch, work_days=WORK_DAYS, work_start=WORK_START, work_end=WORK_END):
+    """
+    Vectorized version of is_at_work for timestamps given as seconds since 1970-01-01
+    
+    Parameters
+    ----------
+    epoch: array of timestamps in seconds
+    work_days: number of working days, starting on Monday
+    work_start: first working hour
+    work_end: hour at which work ends (excluded)
+    
+    Returns
+    ------
+    boolean array, True for tweets posted during working hours
+    """
+
+    # 1970-01-01 was a Thursday, shift so that Monday is 0
+    week_day = (epoch // 86400 + 3) % 7
+    time_of_day = (epoch % 86400) // 3600
+    return working_hours(week_day, time_of_day, work_days, work_start, work_end)
+
+def count_user_cells(user_ids, cells, at_work):
+    """
+    Counts the tweets of each (user, at work, cell) triple with a single sort
+    
+    Parameters
+    ----------
+    user_ids: array of user IDs
+    cells: array of cell IDs created by encode_cells
+    at_work: boolean array, True for tweets posted during working hours
+    
+    Returns
+    ------
+    tuple of arrays (users, work, cells, counts), one entry per triple, sorted by user
+    """
+
+    user_ids = np.asarray(user_ids)
+    cells = np.asarray(cells)
+    at_work = np.asarray(at_work, dtype=bool)
+    # ignore tweets without coordinates
+    valid = cells >= 0
+    user_ids, cells, at_work = user_ids[valid], cells[valid], at_work[valid]
+    # sort so that equal (user, at work, cell) triples are contiguous
+    order = np.lexsort((cells, at_work, user_ids))
+    user_ids, cells, at_work = user_ids[order], cells[order], at_work[order]
+    new_triple = np.ones(len(user_ids), dtype=bool)
+    new_triple[1:] = ((user_ids[1:] != user_ids[:-1]) | (at_work[1:] != at_work[:-1]) |
+                      (cells[1:] != cells[:-1]))
+    starts = np.flatnonzero(new_triple)
+    # number of tweets per (user, at work, cell)
+    counts = np.diff(np.append(starts, len(user_ids)))
+    return user_ids[starts], at_work[starts], cells[starts], counts
+
+def join_home_and_work(users, work, cells, counts, accuracy, min_tweets=5, errors=None):
+    """
+    Picks the most frequent home and work cell of each user from per-cell counts and joins them
+    
+    Parameters
+    ----------
+    users: array of user IDs
+    work: boolean array, True for counts of tweets posted during working hours
+    cells: array of cell IDs
+    counts: array of number of tweets
+    accuracy: accuracy used to create the cells
+    min_tweets: minimum number of tweets from the home and from the work location
+    errors: optional array with the maximum overestimation of each count
+    
+    Returns
+    ------
+    a dataframe like the joined dataframe of the notebook; if errors are given, the columns homeError and
+    workError are added
+    """
+
+    # for each (user, at work) keep the cell with the most tweets (first cell wins ties)
+    best = np.lexsort((cells, -counts, work, users))
+    first = np.ones(len(best), dtype=bool)
+    first[1:] = (users[best][1:] != users[best][:-1]) | (work[best][1:] != work[best][:-1])
+    best = best[first]
+    # apply the threshold on the number of tweets inline
+    best = best[counts[best] >= min_tweets]
+    home = best[~work[best]]
+    work = best[work[best]]
+    # users with both a home and a work location (both are sorted by user)
+    common, home_index, work_index = np.intersect1d(users[home], users[work], assume_unique=True,
+                                                    return_indices=True)
+    home, work = home[home_index], work[work_index]
+    # remove users whose home and work locations are the same
+    different = cells[home] != cells[work]
+    home, work = home[different], work[different]
+    home_lat, home_long = decode_cells(cells[home], accuracy)
+    work_lat, work_long = decode_cells(cells[work], accuracy)
+    columns = ['tweetsHome', 'homeLatitude', 'homeLongitude', 'tweetsWork', 'workLatitude', 'workLongitude']
+    data = {'tweetsHome': counts[home], 'homeLatitude': home_lat, 'homeLongitude': home_long,
+            'tweetsWork': counts[work], 'workLatitude': work_lat, 'workLongitude': work_long}
+    if errors is not None:
+        columns += ['homeError', 'workError']
+        data['homeError'] = errors[home]
+        data['workError'] = errors[work]
+    return pd.DataFrame(data, index=pd.Index(users[home], name='userId'), columns=columns)
+
+def home_and_work_locations(user_ids, cells, at_work, accuracy, min_tweets=5):
+    """
+    Finds the home and work location of each user in one pass. The home (work) location is the cell with
+    the most tweets outside (during) working hours, as in most_freq_locations
+    
+    Parameters
+    ----------
+    user_ids: array of user IDs
+    cells: array of cell IDs created by encode_cells
+    at_work: boolean array, True for tweets posted during working hours
+    accuracy: accuracy used to create the cells
+    min_tweets: minimum number of tweets from the home and from the work location
+    
+    Returns
+    ------
+    a dataframe like the joined dataframe of the notebook, with the user ID as index and the columns
+    tweetsHome, homeLatitude, homeLongitude, tweetsWork, workLatitude, workLongitude
+    """
+
+    users, work, cells, counts = count_user_cells(user_ids, cells, at_work)
+    return join_home_and_work(users, work, cells, counts, accuracy, min_tweets)
+
+def home_and_work_locations_memmap(store, accuracy=2, min_tweets=5, max_tweets=5000000, upper_threshold=5000,
+                                   lower_threshold=100):
+    """
+    Finds home and work locations of all users of a memory-mapped store, one slice of users at a time.
+    The tweets are cleaned as in the notebook: only the active users are kept (see get_active_userIds, the
+    offset table gives the number of tweets of each user), and the tweets without coordinates or outside of
+    the bounding box are dropped (see clean_locations; the place coordinates are filled in by
+    build_memmap_store)
+    
+    Parameters
+    ----------
+    store: store opened with open_memmap_store
+    accuracy: how many decimals of the coordinates should be kept
+    min_tweets: minimum number of tweets from the home and from the work location
+    max_tweets: maximum number of tweets per slice, unless a single user has more (see iter_user_chunks)
+    upper_threshold: maximum number of tweets of an active user
+    lower_threshold: minimum number of tweets of an active user
+    
+    Returns
+    ------
+    a dataframe like the joined dataframe of the notebook (users whose home is their work are removed)
+    """
+
+    tweets_per_user = np.diff(store['offsets'])
+    active = (tweets_per_user >= lower_threshold) & (tweets_per_user <= upper_threshold)
+    list_ = []
+    for chunk in iter_user_chunks(store, max_tweets):
+        latitude, longitude = chunk['latitude'], chunk['longitude']
+        # the slices hold whole users, sorted by user ID as the users array
+        keep = active[np.searchsorted(store['users'], chunk['userId'])]
+        keep &= ((LATITUDE_RANGE[0] < latitude) & (latitude < LATITUDE_RANGE[1]) &
+                 (LONGITUDE_RANGE[0] < longitude) & (longitude < LONGITUDE_RANGE[1]))
+        cells = encode_cells(latitude[keep], longitude[keep], accuracy)
+        at_work = at_work_from_epoch(chunk['epoch'][keep])
+        list_.append(home_and_work_locations(chunk['userId'][keep], cells, at_work, accuracy, min_tweets))
+    return pd.concat(list_)
+
+def clean_locations(data):
+    """
+    Applies the preprocessing of the notebook to a dataframe of tweets: fills the GPS coordinates with the
+    place coordinates, drops the rows without coordinates or timestamp and the outliers outside of the
+    bounding box
+
+    Parameters
+    ----------
+    data: dataframe with the columns createdAt, latitude and longitude (and optionally placeLatitude and
+    placeLongitude)
+
+    Returns
+    -------
+    the cleaned dataframe, without the place columns
+    """
+
+    data = data.copy()
+    data['createdAt'] = pd.to_datetime(data['createdAt'], errors='coerce')
+    if 'placeLatitude' in data and 'placeLongitude' in data:
+        data['latitude'] = data['latitude'].fillna(data['placeLatitude'])
+        data['longitude'] = data['longitude'].fillna(data['placeLongitude'])
+        data = data.drop(['placeLatitude', 'placeLongitude'], axis=1)
+    data = data.dropna(subset=['latitude', 'longitude', 'createdAt'])
+    inside = ((LATITUDE_RANGE[0] < data['latitude']) & (data['latitude'] < LATITUDE_RANGE[1]) &
+              (LONGITUDE_RANGE[0] < data['longitude']) & (data['longitude'] < LONGITUDE_RANGE[1]))
+    return data[inside]
+
+def home_and_work_streaming(chunks, accuracy=2, min_tweets=5, k=8, upper_threshold=5000, lower_threshold=100):
+    """
+    Finds home and work locations from chunks of tweets, without holding all tweets in memory. For each
+    user, the cells outside and during working hours are tracked by Space-Saving summaries of at most k
+    counters. Each chunk is cleaned as in the notebook (see clean_locations) and only the active users,
+    counted over all their tweets with a timestamp as get_active_userIds does, are kept at the end.
+    Peak memory is therefore one chunk (its size is set by the reader, e.g. the chunksize of
+    iter_tweet_chunks) plus, for every user seen so far, at most 2 * k counters and a tweet count: it grows
+    with the number of users, not with the number of tweets, and k is the cap to tune
+    
+    Parameters
+    ----------
+    chunks: iterable of dataframes with the columns userId, createdAt, latitude and longitude (and
+    optionally placeLatitude and placeLongitude), e.g. from iter_tweet_chunks('tweets', [year])
+    accuracy: how many decimals of the coordinates should be kept
+    min_tweets: minimum number of tweets from the home and from the work location
+    k: maximum number of cells tracked per user for home and for work
+    upper_threshold: maximum number of tweets of an active user
+    lower_threshold: minimum number of tweets of an active user
+    
+    Returns
+    ------
+    a dataframe like the joined dataframe of the notebook with two more columns, homeError and workError:
+    the true number of tweets from a location is between tweets - error and tweets. An error of 0 means
+    that the count is exact. Whenever a user tweets from at most k cells, no error is possible
+    """
+
+    # (user, at work) -> {cell: [count, error]}
+    summaries = defaultdict(dict)
+    # user -> number of tweets with a timestamp, before cleaning
+    tweets_per_user = Counter()
+    for chunk in chunks:
+        timed = pd.to_datetime(chunk['createdAt'], errors='coerce').notna()
+        tweets_per_user.update(chunk.loc[timed, 'userId'].value_counts().to_dict())
+        chunk = clean_locations(chunk)
+        cells = encode_cells(chunk['latitude'].values, chunk['longitude'].values, accuracy)
+        at_work = time_features(chunk['createdAt'])['atWork'].values
+        # aggregate the chunk first, so that each summary is updated once per cell and chunk
+        users, work, cells, counts = count_user_cells(chunk['userId'].values, cells, at_work)
+        for user, is_work, cell, count in zip(users.tolist(), work.tolist(), cells.tolist(), counts.tolist()):
+            space_saving_update(summaries[(user, is_work)], cell, count, k)
+    # flatten the summaries of the active users, join_home_and_work keeps the top cell of each one
+    entries = [(user, is_work, cell, count, error) for (user, is_work), counters in summaries.items()
+               if lower_threshold <= tweets_per_user[user] <= upper_threshold
+               for cell, (count, error) in counters.items()]
+    entries = np.array(entries, dtype=np.int64).reshape(-1, 5)
+    users, work, cells, counts, errors = entries.T
+    return join_home_and_work(users, work.astype(bool), cells, counts, accuracy, min_tweets, errors)
+
 def get_freq_loc_coordinates(row):
     """
     From given row, extract latitude and longitude from the coordinates tuple
@@ -403,6 +661,272 @@ def find_cantons(row, gmaps, debug=True):
         print('Successful API call')
     return row
 
+def sort_by_user(user_ids, latitude, longitude):
+    """
+    Drops tweets without coordinates and sorts the tweets by user, unless they are already sorted
+
+    Parameters
+    ----------
+    user_ids: array of user IDs
+    latitude: array of latitudes
+    longitude: array of longitudes
+
+    Returns
+    -------
+    tuple of sorted arrays (user_ids, latitude, longitude)
+    """
+
+    user_ids = np.asarray(user_ids)
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    valid = ~(np.isnan(latitude) | np.isnan(longitude))
+    user_ids, latitude, longitude = user_ids[valid], latitude[valid], longitude[valid]
+    if np.any(user_ids[1:] < user_ids[:-1]):
+        order = np.argsort(user_ids, kind='mergesort')
+        user_ids, latitude, longitude = user_ids[order], latitude[order], longitude[order]
+    return user_ids, latitude, longitude
+
+def user_starts(user_ids):
+    """
+    Finds the slice of each user in an array of sorted user IDs
+
+    Parameters
+    ----------
+    user_ids: sorted array of user IDs
+
+    Returns
+    -------
+    tuple (users, index of the first tweet of each user, number of tweets of each user)
+    """
+
+    starts = np.flatnonzero(np.append(True, user_ids[1:] != user_ids[:-1]))
+    return user_ids[starts], starts, np.diff(np.append(starts, len(user_ids)))
+
+def radius_of_gyration(user_ids, latitude, longitude, homes=None):
+    """
+    Estimates the radius of gyration of each user, sqrt(1/n * sum(d(r_i, r_c)^2)), where d is the haversine
+    distance and r_c the center of mass of the user's tweets, or the user's home
+    
+    Parameters
+    ----------
+    user_ids: array of user IDs (the arrays are sorted by user if they are not already)
+    latitude: array of latitudes
+    longitude: array of longitudes
+    homes: dataframe with the user ID as index and the columns homeLatitude and homeLongitude, e.g.
+    travel_data; if given, the radius is anchored at the home and users without home are ignored
+    
+    Returns
+    ------
+    a dataframe with the user ID as index and the columns gyration (km) and tweets; with homes, the
+    homeLatitude and homeLongitude columns come first, as in the gyration files
+    """
+
+    user_ids, latitude, longitude = sort_by_user(user_ids, latitude, longitude)
+    if homes is not None:
+        # keep only the tweets of users with a home location
+        keep = np.isin(user_ids, homes.index.values)
+        user_ids, latitude, longitude = user_ids[keep], latitude[keep], longitude[keep]
+    columns = ['gyration', 'tweets'] if homes is None else ['homeLatitude', 'homeLongitude', 'gyration', 'tweets']
+    if len(user_ids) == 0:
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='userId'))
+    # each user is a contiguous slice that starts at starts[i]
+    users, starts, tweets = user_starts(user_ids)
+    if homes is None:
+        # center of mass of the tweets of each user
+        center_lat = np.add.reduceat(latitude, starts) / tweets
+        center_long = np.add.reduceat(longitude, starts) / tweets
+    else:
+        home = homes.loc[users]
+        center_lat = home['homeLatitude'].values.astype(np.float64)
+        center_long = home['homeLongitude'].values.astype(np.float64)
+    distance = haversine(latitude, longitude, np.repeat(center_lat, tweets), np.repeat(center_long, tweets))
+    gyration = np.sqrt(np.add.reduceat(distance ** 2, starts) / tweets)
+    result = pd.DataFrame({'gyration': gyration, 'tweets': tweets}, index=pd.Index(users, name='userId'))
+    if homes is not None:
+        result['homeLatitude'] = center_lat
+        result['homeLongitude'] = center_long
+    return result[columns]
+
+def gyration_moments(user_ids, latitude, longitude):
+    """
+    Computes the sufficient statistics of the radius of gyration of each user: the number of tweets and
+    the sums of the 3D coordinates of the tweets. Moments of different years, months or batches of
+    tweets are merged exactly with merge_gyration_moments
+
+    Parameters
+    ----------
+    user_ids: array of user IDs
+    latitude: array of latitudes
+    longitude: array of longitudes
+
+    Returns
+    -------
+    a dataframe with the user ID as index and the columns of MOMENT_COLUMNS
+    """
+
+    user_ids, latitude, longitude = sort_by_user(user_ids, latitude, longitude)
+    if len(user_ids) == 0:
+        return pd.DataFrame(columns=MOMENT_COLUMNS, index=pd.Index([], name='userId'))
+    users, starts, tweets = user_starts(user_ids)
+    x, y, z = to_cartesian(latitude, longitude)
+    moments = pd.DataFrame({'tweets': tweets, 'sumX': np.add.reduceat(x, starts),
+                            'sumY': np.add.reduceat(y, starts), 'sumZ': np.add.reduceat(z, starts)},
+                           index=pd.Index(users, name='userId'))
+    return moments[MOMENT_COLUMNS]
+
+def merge_gyration_moments(moments):
+    """
+    Merges the moments of the same users, e.g. of several years loaded with load_all_files('moments')
+
+    Parameters
+    ----------
+    moments: list of dataframes created by gyration_moments, or a single dataframe with one row per user
+    and batch (the user ID either as index or as userId column)
+
+    Returns
+    -------
+    a dataframe with the user ID as index and the columns of MOMENT_COLUMNS
+    """
+
+    if isinstance(moments, (list, tuple)):
+        moments = pd.concat(moments)
+    if 'userId' in moments.columns:
+        moments = moments.set_index('userId')
+    return moments[MOMENT_COLUMNS].groupby(level=0).sum().rename_axis('userId')
+
+def gyration_from_moments(moments, homes=None):
+    """
+    Radius of gyration of each user from the merged moments. Points lie on a sphere, so the sum of the
+    squared distances to a center c is sum(|r_i|^2) - 2 c.sum(r_i) + n |c|^2 with |r_i| = EARTH_RADIUS,
+    which only needs the number of tweets and the sums of coordinates. Distances are chords, which
+    differ from the haversine distances of radius_of_gyration by less than 0.001% below 100 km
+
+    Parameters
+    ----------
+    moments: dataframe created by gyration_moments or merge_gyration_moments
+    homes: dataframe with the user ID as index and the columns homeLatitude and homeLongitude; if given,
+    the radius is anchored at the home and users without home are ignored, otherwise it is taken around
+    the center of mass
+
+    Returns
+    ------
+    a dataframe with the user ID as index and the same columns as radius_of_gyration
+    """
+
+    if homes is not None:
+        moments = moments[moments.index.isin(homes.index)]
+    tweets = moments['tweets'].values.astype(np.float64)
+    sums = moments[['sumX', 'sumY', 'sumZ']].values / tweets[:, None]
+    if homes is None:
+        # the squared distance to the center of mass is R^2 - |mean|^2
+        squared = EARTH_RADIUS ** 2 - np.sum(sums ** 2, axis=1)
+    else:
+        home = homes.loc[moments.index]
+        center = np.column_stack(to_cartesian(home['homeLatitude'].values, home['homeLongitude'].values))
+        # the squared distance to the home is 2 R^2 - 2 home.mean
+        squared = 2 * EARTH_RADIUS ** 2 - 2 * np.sum(center * sums, axis=1)
+    result = pd.DataFrame({'gyration': np.sqrt(np.maximum(squared, 0)), 'tweets': moments['tweets'].values},
+                          index=moments.index)
+    if homes is None:
+        return result
+    result['homeLatitude'] = home['homeLatitude'].values
+    result['homeLongitude'] = home['homeLongitude'].values
+    return result[['homeLatitude', 'homeLongitude', 'gyration', 'tweets']]
+
+def pooled_gyration(gyration_info):
+    """
+    Aggregates the radius of gyration of several years with the pooled variance formula, for years whose
+    moments were not saved; users with a single year keep their radius
+
+    Parameters
+    ----------
+    gyration_info: dataframe with the userId, gyration and tweets columns, e.g. load_all_files('gyration')
+
+    Returns
+    -------
+    series with the average radius of gyration of each user
+    """
+
+    weights = gyration_info['tweets'] - 1
+    grouped = pd.DataFrame({'userId': gyration_info['userId'], 'weights': weights,
+                            'squares': weights * gyration_info['gyration'] ** 2,
+                            'gyration': gyration_info['gyration']}).groupby('userId')
+    sums = grouped[['weights', 'squares']].sum()
+    avg_gyration = np.sqrt(sums['squares'] / sums['weights'])
+    single = grouped.size() == 1
+    avg_gyration[single] = grouped['gyration'].first()[single]
+    return avg_gyration
+
+def fit_commute_model(travel_data):
+    """
+    Fits the offline commute model on travel information returned by the googlemaps API. The road distance
+    is a linear function of the great-circle distance (detour), and the time a function of the road distance
+    that lets the average speed grow with the distance (city vs. highway)
+    
+    Parameters
+    ----------
+    travel_data: dataframe with home and work coordinates, distance (km) and time (min), e.g. the
+    travel_info files
+    
+    Returns
+    ------
+    dict with the coefficients of the model
+    """
+
+    travel_data = travel_data.dropna(subset=['homeLatitude', 'homeLongitude', 'workLatitude', 'workLongitude',
+                                             'distance', 'time'])
+    straight = haversine(travel_data['homeLatitude'].values, travel_data['homeLongitude'].values,
+                         travel_data['workLatitude'].values, travel_data['workLongitude'].values)
+    distance = travel_data['distance'].values
+    # distance = detour * straight + detour_offset
+    A = np.column_stack((straight, np.ones(len(straight))))
+    detour, detour_offset = np.linalg.lstsq(A, distance, rcond=None)[0]
+    # time = time_per_km * distance + time_per_sqrt_km * sqrt(distance) + time_offset
+    A = np.column_stack((distance, np.sqrt(distance), np.ones(len(distance))))
+    time_per_km, time_per_sqrt_km, time_offset = np.linalg.lstsq(A, travel_data['time'].values, rcond=None)[0]
+    return {'detour': detour, 'detour_offset': detour_offset, 'time_per_km': time_per_km,
+            'time_per_sqrt_km': time_per_sqrt_km, 'time_offset': time_offset}
+
+def estimate_commute(joined, model=COMMUTE_MODEL):
+    """
+    Estimates the distance and time to work of all users at once, without the googlemaps API
+    
+    Parameters
+    ----------
+    joined: dataframe with home and work coordinates
+    model: dict created by fit_commute_model
+    
+    Returns
+    ------
+    the dataframe with the distance (km) and time (min) columns filled
+    """
+
+    straight = haversine(joined['homeLatitude'].values, joined['homeLongitude'].values,
+                         joined['workLatitude'].values, joined['workLongitude'].values)
+    distance = model['detour'] * straight + model['detour_offset']
+    joined['distance'] = distance
+    joined['time'] = (model['time_per_km'] * distance + model['time_per_sqrt_km'] * np.sqrt(distance) +
+                      model['time_offset'])
+    return joined
+
+def fill_cantons(joined, geocoder):
+    """
+    Finds the canton of residence and work of all users at once, without the googlemaps API
+    
+    Parameters
+    ----------
+    joined: dataframe with home and work coordinates
+    geocoder: dict created by build_canton_geocoder
+    
+    Returns
+    ------
+    the dataframe with the homeCanton and workCanton columns filled
+    """
+
+    joined['homeCanton'] = lookup_cantons(geocoder, joined['homeLatitude'].values, joined['homeLongitude'].values)
+    joined['workCanton'] = lookup_cantons(geocoder, joined['workLatitude'].values, joined['workLongitude'].values)
+    return joined
+
 def visualize_gyration_radius(short_distance, year):
     """
     Creates a map with the radius of gyrations for users
@@ -459,7 +983,10 @@ def load_all_files(pattern):
     list_ = []
     # iterate through all files and create an aggregated dataframe
     for file_ in all_files:
-        df = pd.read_csv(file_, sep='|')
+        # skip the columnar copies of the files
+        if not file_.endswith('.csv'):
+            continue
+        df = read_cached_csv(file_, sep='|')
         year = re.findall('\d+', file_)[0]
         df['year'] = int(year)
         list_.append(df)
@@ -526,29 +1053,6 @@ def visualize_graph(graph_data, swiss_cantons, seed=1):
     # display
     plt.show()
 
-def estimate_avg_gyration(group):
-    """
-    Estimates the average radius of gyration according to a formula given in the notebook
-
-    Parameters
-    ----------
-    group: subset of dataframe after the groupby operation
-
-    Returns
-    -------
-    the average radius of gyration
-    """
-    
-    if group.shape[0] > 1:
-        # apply formula as given in the notebook
-        avg_gyration = np.sqrt(np.sum((group.tweets - 1) * (group.gyration ** 2)) / np.sum(group.tweets - 1))
-        d = {'avg_gyration': avg_gyration}
-        # return pd.Series(data=d)
-        return avg_gyration
-    d = {'avg_gyration': group.gyration.iloc[0]}
-    # return pd.Series(data=d)
-    return group.gyration.iloc[0]
-
 def different_canton(label):
     """
     Takes a label in the form (x,y) and checks if x is equal to y
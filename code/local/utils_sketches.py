@@ -0,0 +1,221 @@
+from libraries import *
+import bisect
+
+
+def space_saving_update(counters, item, weight, k):
+    """
+    Adds an item to a Space-Saving summary that keeps at most k counters. When the summary is full, the
+    item with the smallest count is replaced and its count becomes the error of the new item
+
+    Parameters
+    ----------
+    counters: dict item -> [count, error], updated in place
+    item: item to be added
+    weight: number of occurrences of the item
+    k: maximum number of counters
+    """
+
+    if item in counters:
+        counters[item][0] += weight
+    elif len(counters) < k:
+        counters[item] = [weight, 0]
+    else:
+        # evict the item with the smallest count
+        smallest = min(counters, key=lambda key: counters[key][0])
+        count = counters.pop(smallest)[0]
+        counters[item] = [count + weight, count]
+
+def hash64(item):
+    """
+    Mixes an integer into a well spread 64-bit hash (splitmix64 finalizer)
+
+    Parameters
+    ----------
+    item: integer to be hashed
+
+    Returns
+    -------
+    hash value in [0, 2^64)
+    """
+
+    mask = 0xFFFFFFFFFFFFFFFF
+    z = (int(item) + 0x9E3779B97F4A7C15) & mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+    return z ^ (z >> 31)
+
+def kmv_add(sketch, item, k):
+    """
+    Adds an item to a k-minimum-values sketch of distinct items, which keeps the k smallest hashes
+
+    Parameters
+    ----------
+    sketch: sorted list of hashes, updated in place
+    item: integer item, e.g. a user ID
+    k: maximum number of hashes
+    """
+
+    value = hash64(item)
+    if len(sketch) == k and value >= sketch[-1]:
+        return
+    position = bisect.bisect_left(sketch, value)
+    if position < len(sketch) and sketch[position] == value:
+        return
+    sketch.insert(position, value)
+    if len(sketch) > k:
+        sketch.pop()
+
+def kmv_merge(sketches, k):
+    """
+    Merges k-minimum-values sketches, the result is the sketch of the union of the items
+
+    Parameters
+    ----------
+    sketches: iterable of sketches
+    k: maximum number of hashes
+
+    Returns
+    -------
+    the merged sketch
+    """
+
+    return sorted(set(value for sketch in sketches for value in sketch))[:k]
+
+def kmv_count(sketch, k):
+    """
+    Estimates the number of distinct items of a k-minimum-values sketch (exact below k items)
+
+    Parameters
+    ----------
+    sketch: sorted list of hashes
+    k: maximum number of hashes
+
+    Returns
+    -------
+    estimated number of distinct items
+    """
+
+    if len(sketch) < k:
+        return len(sketch)
+    return (k - 1) * 2.0 ** 64 / (sketch[-1] + 1)
+
+def hash64_array(values, seed=0):
+    """
+    Vectorized hash64 of an integer array, different seeds give independent hash functions
+
+    Parameters
+    ----------
+    values: array of integers
+    seed: integer seed of the hash function
+
+    Returns
+    -------
+    uint64 array of hash values
+    """
+
+    z = np.asarray(values).astype(np.uint64) + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & 0xFFFFFFFFFFFFFFFF)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def count_min_columns(keys, width, depth):
+    """
+    Finds the column of each key in each row of a count-min table
+
+    Parameters
+    ----------
+    keys: array of integer keys
+    width: number of columns of the table
+    depth: number of rows of the table
+
+    Returns
+    -------
+    (depth, number of keys) array of columns
+    """
+
+    return np.stack([(hash64_array(keys, row) % np.uint64(width)).astype(np.int64) for row in range(depth)])
+
+def count_min_counts(columns, width):
+    """
+    Builds a count-min sketch: each row counts the keys that fall in each of its columns, so every row
+    overestimates the count of a key by the keys it collides with
+
+    Parameters
+    ----------
+    columns: columns of the keys, created by count_min_columns
+    width: number of columns of the table
+
+    Returns
+    -------
+    (depth, width) array of counts
+    """
+
+    depth = len(columns)
+    cells = (columns + np.arange(depth)[:, None] * width).ravel()
+    return np.bincount(cells, minlength=depth * width).reshape(depth, width)
+
+def count_min_query(table, columns):
+    """
+    Estimates the count of keys from a count-min sketch, never below the true count
+
+    Parameters
+    ----------
+    table: count-min sketch, created by count_min_counts
+    columns: columns of the keys, created by count_min_columns
+
+    Returns
+    -------
+    array of estimated counts
+    """
+
+    return np.take_along_axis(table, columns, axis=1).min(axis=0)
+
+def hll_registers(columns, items, width, precision):
+    """
+    Builds a HyperLogLog sketch of the distinct items of each cell of a count-min table. The register of an
+    item is given by the lowest bits of its hash and keeps the maximum rank (position of the leading one
+    bit) of its highest bits
+
+    Parameters
+    ----------
+    columns: columns of the keys, created by count_min_columns
+    items: array of integer items of each key, e.g. user IDs
+    width: number of columns of the table
+    precision: each cell has 2^precision registers (at most 11)
+
+    Returns
+    -------
+    (depth, width, 2^precision) uint8 array of registers
+    """
+
+    depth = len(columns)
+    num_registers = 1 << precision
+    hashes = hash64_array(items, seed=depth)
+    registers = (hashes & np.uint64(num_registers - 1)).astype(np.int64)
+    # the 53 highest bits are exact in float64, frexp gives their bit length
+    rank = 54 - np.frexp((hashes >> np.uint64(11)).astype(np.float64))[1]
+    sketch = np.zeros(depth * width * num_registers, dtype=np.uint8)
+    cells = (columns + np.arange(depth)[:, None] * width) * num_registers + registers
+    np.maximum.at(sketch, cells.ravel(), np.tile(rank.astype(np.uint8), depth))
+    return sketch.reshape(depth, width, num_registers)
+
+def hll_estimate(registers):
+    """
+    Estimates the number of distinct items of HyperLogLog sketches, with linear counting for small counts
+
+    Parameters
+    ----------
+    registers: array of registers, the last axis holds the registers of a sketch
+
+    Returns
+    -------
+    array of estimated numbers of distinct items
+    """
+
+    num_registers = registers.shape[-1]
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(num_registers, 0.7213 / (1 + 1.079 / num_registers))
+    estimate = alpha * num_registers ** 2 / np.exp2(-registers.astype(np.float64)).sum(axis=-1)
+    zeros = (registers == 0).sum(axis=-1)
+    small = (estimate <= 2.5 * num_registers) & (zeros > 0)
+    estimate[small] = num_registers * np.log(num_registers / zeros[small])
+    return estimate
@@ -0,0 +1,113 @@
+from libraries import *
+
+
+# working hours: Monday to Friday, from 08:00 to 18:00
+WORK_DAYS = 5
+WORK_START = 8
+WORK_END = 18
+
+
+def to_local_time(timestamps, timezone=None, source_timezone='UTC'):
+    """
+    Converts naive timestamps to naive local time
+
+    Parameters
+    ----------
+    timestamps: series of naive timestamps
+    timezone: target timezone (e.g. 'Europe/Zurich'), None to keep the timestamps as they are
+    source_timezone: timezone in which the naive timestamps are expressed
+
+    Returns
+    -------
+    series of naive timestamps in local time
+    """
+
+    timestamps = pd.to_datetime(timestamps)
+    if timezone is None:
+        return timestamps
+    return timestamps.dt.tz_localize(source_timezone).dt.tz_convert(timezone).dt.tz_localize(None)
+
+def working_hours(week_day, hour, work_days=WORK_DAYS, work_start=WORK_START, work_end=WORK_END):
+    """
+    Vectorized check of the working hours used by is_at_work
+
+    Parameters
+    ----------
+    week_day: array of week days (Monday is 0)
+    hour: array of hours
+    work_days: number of working days, starting on Monday
+    work_start: first working hour
+    work_end: hour at which work ends (excluded)
+
+    Returns
+    -------
+    boolean array, True for working hours
+    """
+
+    return (week_day < work_days) & (work_start <= hour) & (hour < work_end)
+
+def day_of_tweet(timestamps, as_string=False):
+    """
+    Finds the day of each tweet
+
+    Parameters
+    ----------
+    timestamps: series of timestamps
+    as_string: if True, return the days as 'YYYY-MM-DD' strings
+
+    Returns
+    -------
+    series of days (timestamps at midnight, or strings)
+    """
+
+    days = pd.to_datetime(timestamps).dt.normalize()
+    if as_string:
+        return days.dt.strftime('%Y-%m-%d')
+    return days
+
+def seconds_of_day(timestamps):
+    """
+    Counts the seconds from midnight of each tweet
+
+    Parameters
+    ----------
+    timestamps: series of timestamps
+
+    Returns
+    -------
+    int32 array of seconds from midnight, -1 for missing timestamps
+    """
+
+    timestamps = pd.to_datetime(timestamps)
+    seconds = (timestamps - timestamps.dt.normalize()).dt.total_seconds()
+    return seconds.fillna(-1).values.astype(np.int32)
+
+def time_features(timestamps, timezone=None, source_timezone='UTC', work_days=WORK_DAYS,
+                  work_start=WORK_START, work_end=WORK_END):
+    """
+    Computes the temporal features of the tweets in one vectorized pass
+
+    Parameters
+    ----------
+    timestamps: series of naive timestamps
+    timezone: timezone in which the features are computed, None to use the timestamps as they are
+    source_timezone: timezone in which the naive timestamps are expressed
+    work_days: number of working days, starting on Monday
+    work_start: first working hour
+    work_end: hour at which work ends (excluded)
+
+    Returns
+    -------
+    dataframe with the columns weekDay, hourOfTweet, atWork, dayOfTweet and secondsOfDay, aligned with
+    the given timestamps; missing timestamps get -1 (NaT for dayOfTweet) and are not at work
+    """
+
+    local_time = to_local_time(timestamps, timezone, source_timezone)
+    features = pd.DataFrame(index=local_time.index)
+    features['weekDay'] = local_time.dt.weekday.fillna(-1).astype(np.int8)
+    features['hourOfTweet'] = local_time.dt.hour.fillna(-1).astype(np.int8)
+    features['atWork'] = working_hours(features['weekDay'].values, features['hourOfTweet'].values,
+                                       work_days, work_start, work_end)
+    features['dayOfTweet'] = local_time.dt.normalize()
+    features['secondsOfDay'] = seconds_of_day(local_time)
+    return features
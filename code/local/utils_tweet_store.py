@@ -0,0 +1,442 @@
+from libraries import *
+import hashlib
+
+try:
+    import pyarrow
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+# path to the data files, relative to the notebooks
+DATA_PATH = '../../data/'
+# path to the columnar copies of the csv files
+STORE_PATH = '../../data/store/'
+
+# how each family of tweet files is read (names is None when the file has a header)
+TWEET_FILES = {
+    'tweets': {
+        'names': ['tweetId', 'userId', 'createdAt', 'longitude', 'latitude', 'placeLatitude', 'placeLongitude'],
+        'parse_dates': ['createdAt']
+    },
+    'tweets_with_text': {
+        'names': ['tweetId', 'userId', 'createdAt', 'text'],
+        'parse_dates': ['createdAt']
+    },
+    'processed_tweets': {
+        'names': None,
+        'parse_dates': ['createdAt']
+    }
+}
+
+# version of the layout of the memory-mapped store, older stores are rebuilt
+MEMMAP_VERSION = 2
+
+# compact dtypes used in the store, applied to the columns that exist in a file
+COMPACT_DTYPES = {
+    'tweetId': 'int64',
+    'userId': 'int64',
+    'longitude': 'float32',
+    'latitude': 'float32',
+    'placeLongitude': 'float32',
+    'placeLatitude': 'float32',
+    'hourOfTweet': 'int8',
+    'hashtag': 'category'
+}
+
+
+def compact_dtypes(df):
+    """
+    Converts the columns of a dataframe to the compact dtypes of the store
+
+    Parameters
+    ----------
+    df: dataframe to be converted
+
+    Returns
+    -------
+    the dataframe with compact dtypes
+    """
+
+    for column, dtype in COMPACT_DTYPES.items():
+        if column not in df.columns:
+            continue
+        # integer columns cannot hold NaN, keep them as they are in that case
+        if dtype.startswith('int') and df[column].isnull().any():
+            continue
+        df[column] = df[column].astype(dtype)
+    return df
+
+def read_tweet_csv(kind, year, data_path=DATA_PATH):
+    """
+    Reads a tweet csv file the same way the notebooks do
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    year: year of analysis
+    data_path: folder of the csv files
+
+    Returns
+    -------
+    a dataframe with named columns and parsed dates
+    """
+
+    settings = TWEET_FILES[kind]
+    file_name = data_path + kind + '_' + str(year) + '.csv'
+    if settings['names'] is None:
+        data = pd.read_csv(file_name, sep='|', na_values=['\\N'], parse_dates=settings['parse_dates'])
+    else:
+        data = pd.read_csv(file_name, sep='|', na_values=['\\N'], header=None,
+                           names=settings['names'], parse_dates=settings['parse_dates'])
+    return data
+
+def iter_tweet_chunks(kind, years, columns=None, chunksize=1000000, data_path=DATA_PATH):
+    """
+    Reads the tweet csv files of one or more years in chunks, so that they never have to fit in memory
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    years: list of years
+    columns: list of columns to be kept, None for all columns
+    chunksize: number of lines per chunk
+    data_path: folder of the csv files
+
+    Returns
+    -------
+    generator of dataframes with compact dtypes
+    """
+
+    settings = TWEET_FILES[kind]
+    for year in years:
+        file_name = data_path + kind + '_' + str(year) + '.csv'
+        if settings['names'] is None:
+            reader = pd.read_csv(file_name, sep='|', na_values=['\\N'], parse_dates=settings['parse_dates'],
+                                 usecols=columns, chunksize=chunksize)
+        else:
+            reader = pd.read_csv(file_name, sep='|', na_values=['\\N'], header=None, names=settings['names'],
+                                 parse_dates=settings['parse_dates'], usecols=columns, chunksize=chunksize)
+        for chunk in reader:
+            yield compact_dtypes(chunk)
+
+def is_outdated(source, target):
+    """
+    Checks if a cached file has to be (re)built from its source
+
+    Parameters
+    ----------
+    source: file name of the source file
+    target: file name of the cached file
+
+    Returns
+    -------
+    True if the cached file is missing or older than the source
+    """
+
+    if not os.path.isfile(target):
+        return True
+    return os.path.getmtime(target) < os.path.getmtime(source)
+
+def build_tweet_store(kind, year, data_path=DATA_PATH, store_path=STORE_PATH, overwrite=False):
+    """
+    Converts a tweet csv file to a Parquet file with compact dtypes
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    year: year of analysis
+    data_path: folder of the csv files
+    store_path: folder of the Parquet files
+    overwrite: if True, rebuild the Parquet file even if it is up to date
+
+    Returns
+    -------
+    file name of the Parquet file
+    """
+
+    source = data_path + kind + '_' + str(year) + '.csv'
+    target = store_path + kind + '_' + str(year) + '.parquet'
+    if overwrite or is_outdated(source, target):
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        data = compact_dtypes(read_tweet_csv(kind, year, data_path))
+        data.to_parquet(target, index=False)
+    return target
+
+def load_tweets(kind, years, columns=None, data_path=DATA_PATH, store_path=STORE_PATH):
+    """
+    Loads tweets of one or more years from the columnar store, building it from the csv files if needed
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    years: a single year, or a list of years
+    columns: list of columns to be loaded, None for all columns
+    data_path: folder of the csv files
+    store_path: folder of the Parquet files
+
+    Returns
+    -------
+    a dataframe with the requested columns; when a list of years is given, a 'year' column is added
+    """
+
+    # a single year is loaded as is
+    if not isinstance(years, (list, tuple)):
+        return load_year(kind, years, columns, data_path, store_path)
+    list_ = []
+    for year in years:
+        df = load_year(kind, year, columns, data_path, store_path)
+        df['year'] = int(year)
+        list_.append(df)
+    frame = pd.concat(list_)
+    frame.reset_index(inplace=True, drop=True)
+    return frame
+
+def load_year(kind, year, columns=None, data_path=DATA_PATH, store_path=STORE_PATH):
+    """
+    Loads the tweets of one year from the columnar store
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    year: year of analysis
+    columns: list of columns to be loaded, None for all columns
+    data_path: folder of the csv files
+    store_path: folder of the Parquet files
+
+    Returns
+    -------
+    a dataframe with the requested columns
+    """
+
+    if not PARQUET_AVAILABLE:
+        # no Parquet engine, fall back to the csv file
+        data = compact_dtypes(read_tweet_csv(kind, year, data_path))
+        return data if columns is None else data[columns]
+    file_name = build_tweet_store(kind, year, data_path, store_path)
+    return pd.read_parquet(file_name, columns=columns)
+
+def read_cached_csv(file_name, store_path=STORE_PATH, **kwargs):
+    """
+    Reads a csv file through a Parquet copy. The copy is keyed by the path of the csv file, the arguments of
+    pd.read_csv and the modification time of the file, so a changed file or other arguments never get a stale
+    copy. Only the older copies of the same path read with the same arguments are removed, the copies of
+    other files with the same name or read with other arguments are kept
+
+    Parameters
+    ----------
+    file_name: file name of the csv file
+    store_path: folder of the Parquet files
+    kwargs: arguments passed to pd.read_csv
+
+    Returns
+    -------
+    dataframe with the content of the csv file
+    """
+
+    if not PARQUET_AVAILABLE:
+        return pd.read_csv(file_name, **kwargs)
+    key = repr((os.path.abspath(file_name), sorted(kwargs.items())))
+    prefix = (store_path + os.path.splitext(os.path.basename(file_name))[0] + '_' +
+              hashlib.md5(key.encode('utf-8')).hexdigest()[:16] + '_')
+    version = repr(os.path.getmtime(file_name))
+    target = prefix + hashlib.md5(version.encode('utf-8')).hexdigest()[:8] + '.parquet'
+    if os.path.isfile(target):
+        return pd.read_parquet(target)
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+    for old_copy in glob.glob(glob.escape(prefix) + '?' * 8 + '.parquet'):
+        os.remove(old_copy)
+    df = pd.read_csv(file_name, **kwargs)
+    df.to_parquet(target)
+    return df
+
+def memmap_chunks(kind, year, chunksize, data_path=DATA_PATH):
+    """
+    Reads the fixed-width columns of a tweet csv file in chunks, as stored by build_memmap_store
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    year: year of analysis
+    chunksize: number of lines per chunk
+    data_path: folder of the csv files
+
+    Returns
+    -------
+    generator of (userId, epoch, latitude, longitude) arrays, without the rows that miss the user or time.
+    Missing GPS coordinates are filled with the place coordinates when the file has them, as in the notebook
+    """
+
+    columns = ['userId', 'createdAt', 'latitude', 'longitude']
+    places = 'placeLatitude' in (TWEET_FILES[kind]['names'] or [])
+    if places:
+        columns += ['placeLatitude', 'placeLongitude']
+    for chunk in iter_tweet_chunks(kind, [year], columns, chunksize, data_path):
+        chunk['createdAt'] = pd.to_datetime(chunk['createdAt'], errors='coerce')
+        chunk = chunk.dropna(subset=['userId', 'createdAt'])
+        if places:
+            chunk['latitude'] = chunk['latitude'].fillna(chunk['placeLatitude'])
+            chunk['longitude'] = chunk['longitude'].fillna(chunk['placeLongitude'])
+        yield (chunk['userId'].values.astype(np.int64),
+               chunk['createdAt'].values.astype('datetime64[s]').astype(np.int64),
+               chunk['latitude'].values.astype(np.float32), chunk['longitude'].values.astype(np.float32))
+
+def build_memmap_store(kind, year, data_path=DATA_PATH, store_path=STORE_PATH, overwrite=False,
+                       chunksize=1000000):
+    """
+    Writes the tweets of one year as fixed-width NumPy arrays sorted by user ID, so that they can be
+    memory-mapped. Each user's tweets are a contiguous slice, found through a CSR-style offset table.
+    The csv file is read in chunks twice: the first pass counts the tweets of each user, the second
+    writes each chunk at the offsets of its users; finally the tweets of each slice of users are sorted
+    by time in place. Peak memory is one chunk of chunksize lines (or the tweets of the largest user, if
+    larger, during the sort) plus the per-user tables: the counts of the first pass and the users, offsets and
+    write positions, a few dozen bytes per user. The tweet arrays themselves stay on disk
+
+    Parameters
+    ----------
+    kind: family of the file, one of the keys of TWEET_FILES
+    year: year of analysis
+    data_path: folder of the csv files
+    store_path: folder of the store
+    overwrite: if True, rebuild the arrays even if they are up to date
+    chunksize: number of lines per chunk
+
+    Returns
+    -------
+    folder that contains the arrays
+    """
+
+    folder = store_path + kind + '_' + str(year) + '/'
+    source = data_path + kind + '_' + str(year) + '.csv'
+    if not overwrite and not is_outdated(source, folder + 'offsets.npy') and memmap_version(folder) == MEMMAP_VERSION:
+        return folder
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    elif os.path.isfile(folder + 'offsets.npy'):
+        # the store is incomplete until offsets.npy is written again
+        os.remove(folder + 'offsets.npy')
+    # first pass: number of tweets of each user
+    counts = Counter()
+    for user_ids, _, _, _ in memmap_chunks(kind, year, chunksize, data_path):
+        users, user_counts = np.unique(user_ids, return_counts=True)
+        counts.update(dict(zip(users.tolist(), user_counts.tolist())))
+    users = np.array(sorted(counts), dtype=np.int64)
+    sizes = np.array([counts[user] for user in users.tolist()], dtype=np.int64)
+    # users[i] owns the tweets offsets[i]:offsets[i + 1]
+    offsets = np.append(0, np.cumsum(sizes)).astype(np.int64)
+    dtypes = {'userId': np.int64, 'epoch': np.int64, 'latitude': np.float32, 'longitude': np.float32}
+    arrays = {name: np.lib.format.open_memmap(folder + name + '.npy', mode='w+', dtype=dtype,
+                                              shape=(int(offsets[-1]),)) for name, dtype in dtypes.items()}
+    # second pass: write the tweets of each chunk after the tweets of the same users of previous chunks
+    filled = offsets[:-1].copy()
+    for chunk in memmap_chunks(kind, year, chunksize, data_path):
+        index = np.searchsorted(users, chunk[0])
+        order = np.argsort(index, kind='mergesort')
+        index = index[order]
+        first = np.flatnonzero(np.append(True, index[1:] != index[:-1]))
+        rank = np.arange(len(index)) - np.repeat(first, np.diff(np.append(first, len(index))))
+        positions = filled[index] + rank
+        for name, values in zip(['userId', 'epoch', 'latitude', 'longitude'], chunk):
+            arrays[name][positions] = values[order]
+        np.add.at(filled, index, 1)
+    # sort the tweets of each user by time, one slice of users at a time
+    start = 0
+    while start < len(users):
+        end = max(np.searchsorted(offsets, offsets[start] + chunksize, side='right') - 1, start + 1)
+        end = min(end, len(users))
+        tweets = slice(offsets[start], offsets[end])
+        order = np.lexsort((arrays['epoch'][tweets], arrays['userId'][tweets]))
+        for name in arrays:
+            arrays[name][tweets] = arrays[name][tweets][order]
+        start = end
+    for name in list(arrays):
+        arrays[name].flush()
+        del arrays[name]
+    # offsets.npy is written last, its presence marks a complete store
+    for name, values in [('users', users), ('version', np.array([MEMMAP_VERSION])), ('offsets', offsets)]:
+        array = np.lib.format.open_memmap(folder + name + '.npy', mode='w+', dtype=values.dtype,
+                                          shape=values.shape)
+        array[:] = values
+        array.flush()
+        del array
+    return folder
+
+def memmap_version(folder):
+    """
+    Returns the layout version of a memory-mapped store, 1 for the stores written before versions were recorded
+
+    Parameters
+    ----------
+    folder: folder that contains the arrays
+
+    Returns
+    -------
+    version of the store, None if there is no store
+    """
+
+    if not os.path.isfile(folder + 'offsets.npy'):
+        return None
+    if not os.path.isfile(folder + 'version.npy'):
+        return 1
+    return int(np.load(folder + 'version.npy')[0])
+
+def open_memmap_store(folder):
+    """
+    Opens the arrays written by build_memmap_store without loading them in memory
+
+    Parameters
+    ----------
+    folder: folder that contains the arrays
+
+    Returns
+    -------
+    dict of read-only memory-mapped arrays (userId, epoch, latitude, longitude, users, offsets)
+    """
+
+    names = ['userId', 'epoch', 'latitude', 'longitude', 'users', 'offsets']
+    return {name: np.load(folder + name + '.npy', mmap_mode='r') for name in names}
+
+def is_memmap_store(data):
+    """
+    Checks if the given data is a store opened with open_memmap_store
+
+    Parameters
+    ----------
+    data: dataframe or memory-mapped store
+
+    Returns
+    -------
+    True or False
+    """
+
+    return isinstance(data, dict) and 'offsets' in data
+
+def iter_user_chunks(store, max_tweets=5000000):
+    """
+    Iterates over the store in slices that contain whole users, so that per-user computations can run
+    on one slice at a time. A slice holds at most max_tweets tweets, except when a single user has more, and
+    its arrays are views of the memory-mapped store; the users and offsets tables of the whole store are
+    read to cut the slices (16 bytes per user)
+
+    Parameters
+    ----------
+    store: store opened with open_memmap_store
+    max_tweets: maximum number of tweets per slice, unless a single user has more
+
+    Returns
+    -------
+    generator of dicts with the userId, epoch, latitude and longitude slices (views, not copies)
+    """
+
+    offsets = store['offsets']
+    num_users = len(store['users'])
+    first = 0
+    while first < num_users:
+        # last user whose tweets fit in the slice, at least one user per slice
+        last = np.searchsorted(offsets, offsets[first] + max_tweets, side='right') - 1
+        last = min(max(last, first + 1), num_users)
+        start, stop = offsets[first], offsets[last]
+        yield {name: store[name][start:stop] for name in ['userId', 'epoch', 'latitude', 'longitude']}
+        first = last
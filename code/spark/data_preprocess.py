@@ -1,11 +1,113 @@
 import argparse
+from datetime import datetime
 from pyspark import SparkContext, SparkConf
 from pyspark.sql import SQLContext
 from pyspark.sql.types import *
 
+# schema of the typed output, in the order of the projected attributes
+TWEET_SCHEMA = StructType([
+        StructField("tweetId", LongType(), True),
+        StructField("createdAt", TimestampType(), True),
+        StructField("userId", LongType(), True),
+        StructField("longitude", DoubleType(), True),
+        StructField("latitude", DoubleType(), True),
+        StructField("placeLatitude", DoubleType(), True),
+        StructField("placeLongitude", DoubleType(), True),
+        StructField("year", IntegerType(), True),
+        StructField("month", IntegerType(), True)
+])
+
 def toCSVLine(data):
         return '|'.join(str(attribute) for attribute in data)
 
+def count_and_validate(row, total, valid):
+        """
+        Keeps only valid lines and updates the before/after counters on the way
+
+        Parameters
+        ----------
+        row: list of attributes of a line
+        total: accumulator for the number of lines read
+        valid: accumulator for the number of valid lines
+
+        Returns
+        -------
+        True if the line is valid, otherwise False
+        """
+
+        total.add(1)
+        # valid lines have 20 attributes
+        if len(row) == 20:
+                valid.add(1)
+                return True
+        return False
+
+def parse_value(value, cast):
+        """
+        Converts a raw attribute to the given type
+
+        Parameters
+        ----------
+        value: attribute as string
+        cast: type constructor (int, float)
+
+        Returns
+        -------
+        the converted value, or None for missing or malformed values
+        """
+
+        try:
+                return cast(value)
+        except (TypeError, ValueError):
+                return None
+
+def parse_row(row):
+        """
+        Converts a valid line to a typed tuple that matches TWEET_SCHEMA
+
+        Parameters
+        ----------
+        row: list of attributes of a valid line
+
+        Returns
+        -------
+        tuple of typed attributes, or None if createdAt cannot be parsed
+        """
+
+        # tweetId, userId and createdAt are the first three attributes of a line
+        try:
+                created_at = datetime.strptime(row[2][:19], "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+                return None
+        return (parse_value(row[0], int), created_at, parse_value(row[1], int),
+                parse_value(row[4], float), parse_value(row[5], float),
+                parse_value(row[10], float), parse_value(row[11], float),
+                created_at.year, created_at.month)
+
+def write_parquet(sqlContext, valid_lines, args):
+        """
+        Writes the valid lines as typed Parquet, partitioned by year (and month)
+
+        Parameters
+        ----------
+        sqlContext: SQLContext object
+        valid_lines: RDD of valid lines
+        args: parsed command line arguments
+        """
+
+        # parse createdAt once and drop lines with a malformed date
+        typed = valid_lines.map(parse_row).filter(lambda row: row is not None)
+        if args.year is not None:
+                # compare years as numbers, not as substrings of the raw line
+                year = int(args.year)
+                typed = typed.filter(lambda row: row[7] == year)
+        tweets = sqlContext.createDataFrame(typed, TWEET_SCHEMA)
+        partitions = ["year", "month"] if args.partition_by_month else ["year"]
+        # only replace the partitions that are written, so that --year keeps the other years
+        sqlContext.setConf("spark.sql.sources.partitionOverwriteMode", "dynamic")
+        # save result to hdfs
+        tweets.write.mode("overwrite").partitionBy(*partitions).parquet(args.output)
+
 def main(args):
         # initialize sc
         sc = SparkContext()
@@ -14,25 +116,39 @@ def main(args):
         dataset = sc.textFile("/datasets/twitter-swisscom/twex.tsv")
         # split each line according to separator
         tokens = dataset.map(lambda l: l.split("\t"))
-        # count tweets before filtering
-        before = tokens.count()
-        # keep only valid lines. valid lines have 20 attributes
-        valid_lines = tokens.filter(lambda row: len(row) == 20)
-        # count tweets after filtering
-        after = valid_lines.count()
-        # from each line, keep only necessary attributes
-        projection = valid_lines.map(lambda row: [row[1], row[2], row[4], row[5], row[10], row[11]])
-        if args.year is not None:
-                # filter according to year of tweet
-                result = projection.filter(lambda row: args.year in row[1])
-                result = result.map(toCSVLine)
-                # save result to hdfs
-                file_path = "/user/giannako/tweets_" + args.year
-                result.saveAsTextFile(file_path)
+        if args.exact_counts:
+                # count tweets before filtering
+                before = tokens.count()
+                # keep only valid lines. valid lines have 20 attributes
+                valid_lines = tokens.filter(lambda row: len(row) == 20)
+                # count tweets after filtering
+                after = valid_lines.count()
+        else:
+                # count lines while filtering, so that the dataset is read only once by the write action.
+                # accumulators may over-count if a task is retried, use --exact-counts if that matters
+                total = sc.accumulator(0)
+                valid = sc.accumulator(0)
+                valid_lines = tokens.filter(lambda row: count_and_validate(row, total, valid))
+        if args.format == "parquet":
+                write_parquet(sqlContext, valid_lines, args)
         else:
-                # save all tweets to hdfs
-                projection = projection.map(toCSVLine)
-                projection.saveAsTextFile("/user/giannako/tweets_all")
+                # from each line, keep only necessary attributes
+                projection = valid_lines.map(lambda row: [row[1], row[2], row[4], row[5], row[10], row[11]])
+                if args.year is not None:
+                        # filter according to year of tweet
+                        result = projection.filter(lambda row: args.year in row[1])
+                        result = result.map(toCSVLine)
+                        # save result to hdfs
+                        file_path = "/user/giannako/tweets_" + args.year
+                        result.saveAsTextFile(file_path)
+                else:
+                        # save all tweets to hdfs
+                        projection = projection.map(toCSVLine)
+                        projection.saveAsTextFile("/user/giannako/tweets_all")
+        if not args.exact_counts:
+                # accumulators are only filled once the write action has run
+                before = total.value
+                after = valid.value
         # log messages
         if not args.quiet:
                 print("Before filtering: ", before)
@@ -45,5 +161,13 @@ if __name__ == "__main__":
         argparser = argparse.ArgumentParser()
         argparser.add_argument("--year", type=str, help="Select which year to filter", default=None)
         argparser.add_argument("--quiet", action="store_true")
+        argparser.add_argument("--exact-counts", action="store_true",
+                               help="Count lines with separate count() actions instead of accumulators")
+        argparser.add_argument("--format", choices=["text", "parquet"], default="text",
+                               help="Write pipe-delimited text or typed Parquet partitioned by year")
+        argparser.add_argument("--partition-by-month", action="store_true",
+                               help="Also partition the Parquet output by month")
+        argparser.add_argument("--output", type=str, help="Output path of the Parquet dataset",
+                               default="/user/giannako/tweets_parquet")
         parsed_args = argparser.parse_args()
         main(parsed_args)
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""
+Tests of the parsing of the raw tweets into the typed Parquet output, run with `python -m pytest` from this
+directory. They need pyspark, and a Java runtime for the local Spark context.
+"""
+from datetime import datetime
+
+import pytest
+
+pyspark = pytest.importorskip("pyspark")
+
+from data_preprocess import TWEET_SCHEMA, parse_row, write_parquet
+
+
+# one line of twex.tsv: tweetId, userId, createdAt, text, longitude, latitude, ..., placeLatitude,
+# placeLongitude, ... (20 tab separated attributes)
+SAMPLE_LINE = "\t".join([
+        "780455467130146816", "3916111", "2016-09-26 17:03:21.0",
+        "Feierabend am See #zurich", "8.5437", "47.3667", "de", "N", "\\N", "Zurich",
+        "47.36667", "8.55", "city", "Switzerland", "CH", "Twitter for iPhone", "0", "0", "\\N", "\\N"])
+
+
+class Arguments(object):
+
+        def __init__(self, output, year=None, partition_by_month=False):
+                self.output = output
+                self.year = year
+                self.partition_by_month = partition_by_month
+
+
+def test_parse_row_matches_schema():
+        row = SAMPLE_LINE.split("\t")
+        assert len(row) == 20
+        parsed = dict(zip(TWEET_SCHEMA.fieldNames(), parse_row(row)))
+        assert parsed == {"tweetId": 780455467130146816, "createdAt": datetime(2016, 9, 26, 17, 3, 21),
+                          "userId": 3916111, "longitude": 8.5437, "latitude": 47.3667,
+                          "placeLatitude": 47.36667, "placeLongitude": 8.55, "year": 2016, "month": 9}
+
+def test_parse_row_drops_malformed_dates():
+        row = SAMPLE_LINE.split("\t")
+        row[2] = "\\N"
+        assert parse_row(row) is None
+
+def test_write_parquet(tmpdir):
+        from pyspark import SparkContext
+        from pyspark.sql import SQLContext
+        sc = SparkContext("local[1]", "test_data_preprocess")
+        try:
+                sqlContext = SQLContext(sc)
+                lines = sc.parallelize([SAMPLE_LINE]).map(lambda l: l.split("\t"))
+                output = str(tmpdir.join("tweets_parquet"))
+                write_parquet(sqlContext, lines, Arguments(output, year="2016"))
+                rows = sqlContext.read.parquet(output).collect()
+        finally:
+                sc.stop()
+        assert len(rows) == 1
+        assert rows[0]["userId"] == 3916111
+        assert rows[0]["createdAt"] == datetime(2016, 9, 26, 17, 3, 21)
+        assert rows[0]["year"] == 2016